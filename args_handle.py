@@ -1,8 +1,75 @@
 #!/usr/bin/env python
 
 from optparse import OptionParser
+import bz2
+import collections
+import datetime
+import functools
 import glob
+import gzip
+import heapq
+import json
+import lzma
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 64 * 1024
+SPLIT_SIZE = 32 * 1024 * 1024
+PREFETCH_DEPTH = 64
+SETTLE_SECONDS = 5
+
+COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.lzma': 'xz', '.zst': 'zstd'}
+# Errors of a compressed file cut short or still being written
+DECOMPRESS_ERRORS = (EOFError, OSError, zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ())
+MAGICS = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+SlowlogEntry = collections.namedtuple('SlowlogEntry', ['id', 'timestamp', 'duration', 'command', 'args'])
+
+# One entry of 'redis-cli slowlog get' output looks like:
+#
+#   1) 1) (integer) 14
+#      2) (integer) 1309448221
+#      3) (integer) 15
+#      4) 1) "slowlog"
+#         2) "get"
+#      5) "127.0.0.1:58217"
+#      6) ""
+#
+# Field 5 and 6 only exist since redis 4.0, they are skipped.
+ENTRY_START_RE = re.compile(br'^\s*\d+\)\s+1\)\s+\(integer\)\s+(-?\d+)\s*$')
+ITEM_RE = re.compile(br'^(\s*)(\d+)\)\s+(.*?)\s*$')
+INTEGER_RE = re.compile(br'^\(integer\)\s+(-?\d+)$')
+ESCAPE_RE = re.compile(br'\\(x[0-9a-fA-F]{2}|.)')
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'a': b'\a', b'b': b'\b'}
+UNSAFE_RE = re.compile(r'[\s"\\]|[^\x21-\x7e]')
+
+# Commands acting on no key, their first argument is a subcommand, a
+# pattern or a channel.
+KEYLESS_COMMANDS = frozenset([
+    'acl', 'auth', 'bgrewriteaof', 'bgsave', 'client', 'cluster', 'command', 'config', 'dbsize', 'debug',
+    'discard', 'echo', 'exec', 'failover', 'flushall', 'flushdb', 'function', 'hello', 'info', 'keys',
+    'lastsave', 'latency', 'lolwut', 'module', 'monitor', 'multi', 'ping', 'psubscribe', 'psync', 'publish',
+    'pubsub', 'punsubscribe', 'quit', 'randomkey', 'readonly', 'readwrite', 'replicaof', 'reset', 'role',
+    'save', 'scan', 'script', 'select', 'shutdown', 'slaveof', 'slowlog', 'spublish', 'ssubscribe',
+    'subscribe', 'sunsubscribe', 'swapdb', 'sync', 'time', 'unsubscribe', 'unwatch', 'wait',
+])
+# Commands whose first key follows numkeys, like 'eval script numkeys key'.
+NUMKEYS_COMMANDS = frozenset(['eval', 'eval_ro', 'evalsha', 'evalsha_ro', 'fcall', 'fcall_ro'])
+# Commands whose key follows a subcommand, like 'object encoding key'.
+SUBCOMMAND_KEY_COMMANDS = frozenset(['memory', 'object', 'xgroup', 'xinfo'])
 
 def getFileAbspath(path):
         """Transform any path to absolutely path.
@@ -22,9 +89,29 @@ def getFileAbspath(path):
 def argsHandle():
     parser = OptionParser(description='Redis slowlog formator', usage='python slowlog_formator.py -i <input_files>')
     parser.add_option('-i', dest='input_files', help='read logs from input_files')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='parse files with JOBS processes, 0 means one per CPU [default: %default]')
+    parser.add_option('--reader', dest='reader', type='choice', choices=['mmap', 'stream'], default='mmap',
+                      help='read files by mmap or by chunks of stream [default: %default]')
+    parser.add_option('-s', '--stats', dest='stats', action='store_true', default=False,
+                      help='print aggregates instead of formatted lines')
+    parser.add_option('-n', '--top', dest='top', type='int', default=10,
+                      help='count of slowest entries and hot keys in aggregates [default: %default]')
+    parser.add_option('-c', '--checkpoint', dest='checkpoint',
+                      help='only read data appended since last run, offsets are saved in CHECKPOINT')
+    parser.add_option('-f', '--follow', dest='follow', action='store_true', default=False,
+                      help='keep reading data appended to input files, like tail -f')
+    parser.add_option('--interval', dest='interval', type='float', default=10,
+                      help='seconds between two reads in follow mode [default: %default]')
     (opts, args) = parser.parse_args()
     if not opts.input_files:
         parser.error('-i option is required')
+    if opts.jobs < 0:
+        parser.error('--jobs must not be negative')
+    if opts.top < 1:
+        parser.error('--top must be positive')
+    if opts.interval <= 0:
+        parser.error('--interval must be positive')
     # INPUT_FILES = glob.glob(getFileAbspath(opts.input_files))
     return opts
 
@@ -32,10 +119,915 @@ def do_something():
     # do something
     pass
 
+def compression_of(path):
+    """Get the compression of a file by its extension or magic bytes.
+
+    Args:
+        path: A path of file
+
+    Return:
+        'gzip', 'bz2', 'xz', 'zstd', or None for plain file
+
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in COMPRESSIONS:
+        return COMPRESSIONS[ext]
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in MAGICS:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def open_input(path):
+    """Open a file for reading, decompress it on the fly if compressed.
+
+    Args:
+        path: A path of plain or compressed file
+
+    Return:
+        A file object in binary mode
+
+    """
+    compression = compression_of(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    elif compression == 'bz2':
+        return bz2.open(path, 'rb')
+    elif compression == 'xz':
+        return lzma.open(path, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise IOError('zstandard module is required to read %r' % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+def read_chunks(path, start=0, chunk_size=CHUNK_SIZE):
+    """Read a file in fixed-size chunks, decompressed if compressed.
+
+    Args:
+        path: A path of file
+        start: Offset to begin with, only plain files can seek
+        chunk_size: Bytes read from the file each time
+
+    Return:
+        A generator of chunks (bytes)
+
+    """
+    with open_input(path) as f:
+        if start:
+            f.seek(start)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def split_lines(chunks, start=0, end=None):
+    """Split chunks of a file to lines.
+
+    Only one chunk and the unfinished line of the previous chunk are
+    kept in memory, whatever the size of the file.
+
+    Args:
+        chunks: Any iterable of chunks (bytes)
+        start: Offset of the first chunk in the file
+        end: Lines beginning at or after this offset are not yielded,
+            None means the end of file
+
+    Return:
+        A generator of lines (bytes, without the line break)
+
+    """
+    pos = start
+    tail = b''
+    for chunk in chunks:
+        if end is not None and pos >= end:
+            return
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if end is not None and pos >= end:
+                return
+            pos += len(line) + 1
+            yield line
+    if tail and (end is None or pos < end):
+        yield tail
+
+def iter_lines(path, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """Read lines from a file in fixed-size chunks.
+
+    Args:
+        path: A path of plain or compressed file
+        start: Offset of the first line to read, only for plain file
+        end: Lines beginning at or after this offset are not read,
+            None means the end of file
+        chunk_size: Bytes read from the file each time
+
+    Return:
+        A generator of lines (bytes, without the line break)
+
+    """
+    return split_lines(read_chunks(path, start, chunk_size), start, end)
+
+def prefetch_chunks(paths, depth=PREFETCH_DEPTH):
+    """Read files in a background thread ahead of the consumer.
+
+    Decompression of next files goes on while the chunks of previous
+    ones are being parsed, at most depth chunks are buffered.
+
+    Args:
+        paths: A list of file path
+        depth: Count of chunks buffered
+
+    Return:
+        A generator of chunk generators, one for each path in order,
+        each one must be exhausted before taking the next
+
+    """
+    chunks = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for path in paths:
+                for chunk in read_chunks(path):
+                    if not put(chunk):
+                        return
+                put(None)
+        except Exception as e:
+            put(e)
+
+    def consume():
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        for path in paths:
+            yield consume()
+    finally:
+        stop.set()
+
+def iter_lines_mmap(path, start=0, end=None):
+    """Read lines from a memory-mapped file.
+
+    Lines are memoryview slices of the mapped buffer, nothing is copied
+    until a field is matched and decoded, and pages are only read in
+    while scanning. The slices must not be kept after next line.
+
+    Args:
+        path: A path of file
+        start: Offset of the first line to read
+        end: Lines beginning at or after this offset are not read,
+            None means the end of file
+
+    Return:
+        A generator of lines (memoryview, without the line break)
+
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if end is None or end > size:
+            end = size
+        if start >= end:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mm)
+    try:
+        pos = start
+        while pos < end:
+            eol = mm.find(b'\n', pos)
+            if eol < 0:
+                eol = size
+            yield view[pos:eol]
+            pos = eol + 1
+    finally:
+        try:
+            view.release()
+            mm.close()
+        except BufferError:
+            # The caller still holds a slice, the mapping will be
+            # closed when it is garbage collected.
+            pass
+
+def _next_entry_start(f, pos):
+    """Find the offset of the first entry beginning at or after pos.
+
+    Args:
+        f: A file object opened in binary mode
+        pos: Any offset of the file
+
+    Return:
+        The offset of the entry, or the size of file if no more entry
+
+    """
+    if pos > 0:
+        f.seek(pos - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line or ENTRY_START_RE.match(line):
+            return offset
+
+def split_file(path, split_size=SPLIT_SIZE):
+    """Split a file to ranges on entry boundaries.
+
+    Args:
+        path: A path of slowlog file
+        split_size: Approximate bytes of each range
+
+    Return:
+        A list of (path, start, end) tuples, compressed file is
+        never split
+
+    """
+    if compression_of(path):
+        return [(path, 0, None)]
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            end = _next_entry_start(f, start + split_size) if start + split_size < size else size
+            ranges.append((path, start, end))
+            start = end
+    return ranges
+
+def _last_entry_start(path, start, end):
+    """Find the offset of the last entry beginning in a range.
+
+    The range is scanned backward by growing windows, so only the tail
+    of a large file is read.
+
+    Args:
+        path: A path of plain slowlog file
+        start: Offset of the range
+        end: Offset after the range
+
+    Return:
+        The offset of the entry, or start if no entry begins
+
+    """
+    window = CHUNK_SIZE
+    with open(path, 'rb') as f:
+        while True:
+            lo = max(start, end - window)
+            last = None
+            offset = _next_entry_start(f, lo)
+            while offset < end:
+                last = offset
+                offset = _next_entry_start(f, f.tell())
+            if last is not None:
+                return last
+            if lo == start:
+                return start
+            window *= 2
+
+def _unescape(match):
+    value = match.group(1)
+    if len(value) == 3:
+        return bytes(bytearray([int(value[1:], 16)]))
+    return ESCAPES.get(value, value)
+
+def _decode_value(value):
+    """Decode one value printed by redis-cli.
+
+    Args:
+        value: Bytes like b'(integer) 15' or b'"get"'
+
+    Return:
+        An int for integer value, else a str
+
+    """
+    match = INTEGER_RE.match(value)
+    if match:
+        return int(match.group(1))
+    if len(value) >= 2 and value[:1] == b'"' and value[-1:] == b'"':
+        value = ESCAPE_RE.sub(_unescape, value[1:-1])
+    return value.decode('utf-8', 'replace')
+
+def parse_entries(lines):
+    """Parse slowlog entries from the output of 'redis-cli slowlog get'.
+
+    Entries are yielded one by one, an entry is finished when next one
+    begins or the lines are exhausted.
+
+    Args:
+        lines: Any iterable of lines (bytes or memoryview)
+
+    Return:
+        A generator of SlowlogEntry
+
+    """
+    entry_id = None
+    for line in lines:
+        match = ENTRY_START_RE.match(line)
+        if match:
+            if entry_id is not None:
+                yield SlowlogEntry(entry_id, timestamp, duration, command, args)
+            entry_id = int(match.group(1))
+            timestamp = duration = 0
+            command, args = '', []
+            field_indent = None
+            in_args = False
+            continue
+        if entry_id is None:
+            continue
+        match = ITEM_RE.match(line)
+        if not match:
+            continue
+        indent = match.end(1)
+        if field_indent is None or indent <= field_indent:
+            field_indent = indent
+            field, value = int(match.group(2)), match.group(3)
+            in_args = field == 4
+            if field == 2:
+                timestamp = _decode_value(value)
+            elif field == 3:
+                duration = _decode_value(value)
+            elif in_args:
+                match = ITEM_RE.match(value)
+                if match:
+                    command = _decode_value(match.group(3))
+        elif in_args:
+            args.append(_decode_value(match.group(3)))
+    if entry_id is not None:
+        yield SlowlogEntry(entry_id, timestamp, duration, command, args)
+
+def _quote(arg):
+    if arg and not UNSAFE_RE.search(arg):
+        return arg
+    return '"%s"' % arg.encode('unicode_escape').decode('ascii').replace('"', '\\"')
+
+def format_entry(entry):
+    """Format one slowlog entry to a line.
+
+    Args:
+        entry: A SlowlogEntry
+
+    Return:
+        A string like '14 2011-06-30 15:23:41 15us slowlog get'
+
+    """
+    return '%d %s %dus %s' % (
+        entry.id,
+        datetime.datetime.fromtimestamp(entry.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+        entry.duration,
+        ' '.join([_quote(entry.command)] + [_quote(arg) for arg in entry.args])
+    )
+
+class LatencyHistogram(object):
+    """Histogram of durations in fixed log-scale buckets.
+
+    Bucket i holds durations up to GROWTH ** i microseconds, so the
+    memory is fixed and percentiles are within GROWTH of the truth.
+
+    Attributes:
+        count: Count of durations
+        max: The max duration
+        buckets: Count of durations in each bucket
+
+    """
+    GROWTH = 1.1
+    BUCKETS = 256
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, duration):
+        self.count += 1
+        if duration > self.max:
+            self.max = duration
+        index = int(math.ceil(math.log(duration) / math.log(self.GROWTH))) if duration > 1 else 0
+        self.buckets[min(index, self.BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, percent):
+        """Get the approximate duration at the percentile.
+
+        Args:
+            percent: A number between 0 and 100
+
+        Return:
+            Upper bound of the bucket holding the percentile
+
+        """
+        rank = int(math.ceil(self.count * percent / 100.0))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(int(self.GROWTH ** index), self.max)
+        return self.max
+
+class CountMinSketch(object):
+    """Count-min sketch of key frequency in fixed memory.
+
+    Estimates are never lower than the real count. Keys are hashed by
+    crc32, so sketches made in different processes can be merged.
+
+    """
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.tables = [[0] * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        data = key.encode('utf-8', 'replace')
+        return [zlib.crc32(data, seed) % self.width for seed in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count a key.
+
+        Args:
+            key: Any string
+            count: Times to count
+
+        Return:
+            The estimated count of the key
+
+        """
+        estimate = None
+        for table, index in zip(self.tables, self._indexes(key)):
+            table[index] += count
+            if estimate is None or table[index] < estimate:
+                estimate = table[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(table[index] for table, index in zip(self.tables, self._indexes(key)))
+
+    def merge(self, other):
+        self.tables = [[a + b for a, b in zip(mine, theirs)] for mine, theirs in zip(self.tables, other.tables)]
+
+def key_of(command, args):
+    """Get the first key a command acts on.
+
+    Args:
+        command: Command name
+        args: Arguments of the command
+
+    Return:
+        The key, or None for a command acting on no key
+
+    """
+    command = command.lower()
+    if command in KEYLESS_COMMANDS:
+        return None
+    if command in NUMKEYS_COMMANDS:
+        if len(args) < 3 or str(args[1]) == '0':
+            return None
+        return args[2]
+    if command in SUBCOMMAND_KEY_COMMANDS:
+        if len(args) < 2 or str(args[0]).lower() == 'help':
+            return None
+        return args[1]
+    return args[0] if args else None
+
+class SlowlogStats(object):
+    """Aggregates of slowlog entries computed in a single pass.
+
+    Memory is bounded whatever the count of entries: a heap of the top
+    slowest entries, a LatencyHistogram per command, a CountMinSketch of
+    keys and a few hot key candidates.
+
+    Attributes:
+        top: Count of slowest entries and hot keys to keep
+        slowest: Heap of (duration, id, line) of the slowest entries
+        commands: Dict of command name to LatencyHistogram
+        keys: CountMinSketch of keys of commands, see key_of
+        hot_keys: Dict of hot key candidates to estimated count
+
+    """
+    def __init__(self, top=10):
+        self.top = top
+        self.slowest = []
+        self.commands = {}
+        self.keys = CountMinSketch()
+        self.hot_keys = {}
+        self._hot_min = 0
+
+    def _add_slowest(self, item):
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def _add_hot_key(self, key, estimate):
+        if key in self.hot_keys or len(self.hot_keys) < self.top * 4:
+            self.hot_keys[key] = estimate
+        elif estimate > self._hot_min:
+            del self.hot_keys[min(self.hot_keys, key=self.hot_keys.get)]
+            self.hot_keys[key] = estimate
+        else:
+            return
+        self._hot_min = min(self.hot_keys.values())
+
+    def add(self, entry):
+        """Count one entry.
+
+        Args:
+            entry: A SlowlogEntry
+
+        """
+        if len(self.slowest) < self.top or entry.duration > self.slowest[0][0]:
+            self._add_slowest((entry.duration, entry.id, format_entry(entry)))
+        command = entry.command.lower()
+        if command not in self.commands:
+            self.commands[command] = LatencyHistogram()
+        self.commands[command].add(entry.duration)
+        key = key_of(command, entry.args)
+        if key is not None:
+            self._add_hot_key(key, self.keys.add(key))
+
+    def merge(self, other):
+        """Merge aggregates of other entries, like those of another process.
+
+        Args:
+            other: A SlowlogStats
+
+        """
+        for item in other.slowest:
+            self._add_slowest(item)
+        for command, histogram in other.commands.items():
+            if command in self.commands:
+                self.commands[command].merge(histogram)
+            else:
+                self.commands[command] = histogram
+        self.keys.merge(other.keys)
+        candidates = set(self.hot_keys) | set(other.hot_keys)
+        self.hot_keys = {}
+        self._hot_min = 0
+        for key in candidates:
+            self._add_hot_key(key, self.keys.estimate(key))
+
+    def report(self):
+        """Format the aggregates.
+
+        Return:
+            A generator of lines
+
+        """
+        yield 'Top %d slowest entries:' % self.top
+        for duration, entry_id, line in sorted(self.slowest, reverse=True):
+            yield '  %s' % line
+        yield ''
+        yield '%-20s %10s %10s %10s %10s' % ('command', 'count', 'p50(us)', 'p99(us)', 'max(us)')
+        for command, histogram in sorted(self.commands.items(), key=lambda item: -item[1].count):
+            yield '%-20s %10d %10d %10d %10d' % (
+                _quote(command), histogram.count, histogram.percentile(50), histogram.percentile(99), histogram.max)
+        yield ''
+        yield 'Top %d hot keys (estimated count):' % self.top
+        hot_keys = sorted(self.hot_keys.items(), key=lambda item: (-item[1], item[0]))[:self.top]
+        for key, count in hot_keys:
+            yield '  %-40s %10d' % (_quote(key), count)
+
+READERS = {'mmap': iter_lines_mmap, 'stream': iter_lines}
+
+def _range_lines(path, start, end, reader):
+    if compression_of(path):
+        return iter_lines(path)
+    return READERS[reader](path, start, end)
+
+def _format_range(task, reader='mmap'):
+    path, start, end = task
+    return [format_entry(entry) for entry in parse_entries(_range_lines(path, start, end, reader))]
+
+def _iter_format_range(task, reader='mmap'):
+    path, start, end = task
+    for entry in parse_entries(_range_lines(path, start, end, reader)):
+        yield format_entry(entry)
+
+def imap_window(pool, func, tasks, window, inline=None):
+    """Map a function over tasks by a process pool, results in order.
+
+    Unlike Pool.imap, which submits every task up front and buffers the
+    results coming out of order, at most window tasks are submitted
+    ahead of the one being taken.
+
+    Args:
+        pool: A multiprocessing.Pool
+        func: A picklable function of one task
+        tasks: Any iterable of task, taken lazily
+        window: Count of tasks submitted ahead
+        inline: None, or a function of a task giving an iterable run
+            in this process when the task is taken, or None to submit
+            the task to the pool
+
+    Return:
+        A generator of results, the iterable of inline for inline tasks
+
+    """
+    pending = collections.deque()
+    for task in tasks:
+        result = inline(task) if inline else None
+        pending.append((result, None) if result is not None else (None, pool.apply_async(func, (task,))))
+        if len(pending) > window:
+            result, async_result = pending.popleft()
+            yield async_result.get() if async_result else result
+    while pending:
+        result, async_result = pending.popleft()
+        yield async_result.get() if async_result else result
+
+def iter_entries(input_files, reader='mmap'):
+    """Parse slowlog entries of every input file in order.
+
+    Compressed files are decompressed by prefetch_chunks, so the next
+    one is decompressed while the previous one is parsed.
+
+    Args:
+        input_files: A list of slowlog file path
+        reader: 'mmap' or 'stream' for plain files, see iter_lines_mmap
+            and iter_lines
+
+    Return:
+        A generator of SlowlogEntry
+
+    """
+    compressions = [compression_of(path) for path in input_files]
+    prefetched = prefetch_chunks([path for path, compression in zip(input_files, compressions) if compression])
+    try:
+        for path, compression in zip(input_files, compressions):
+            if compression:
+                lines = split_lines(next(prefetched))
+            else:
+                lines = READERS[reader](path)
+            for entry in parse_entries(lines):
+                yield entry
+    finally:
+        prefetched.close()
+
+def log_parser(input_files, jobs=1, reader='mmap'):
+    """Format slowlog entries of every input file.
+
+    With more than one job, files are split on entry boundaries and
+    the pieces are parsed by a process pool, lines still come out in
+    the order of input files. At most jobs*2 pieces are in flight, and
+    a compressed file, which can not be split, is streamed by this
+    process when its turn comes, so no whole file is held in memory.
+
+    Args:
+        input_files: A list of slowlog file path
+        jobs: Count of processes, 0 means one per CPU
+        reader: 'mmap' or 'stream' for plain files, see iter_lines_mmap
+            and iter_lines
+
+    Return:
+        A generator of formatted lines
+
+    """
+    if jobs == 1:
+        for entry in iter_entries(input_files, reader):
+            yield format_entry(entry)
+        return
+    jobs = jobs or os.cpu_count()
+    tasks = (task for path in input_files for task in split_file(path))
+
+    def inline(task):
+        return _iter_format_range(task, reader) if compression_of(task[0]) else None
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for lines in imap_window(pool, functools.partial(_format_range, reader=reader), tasks, jobs * 2, inline):
+            for line in lines:
+                yield line
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _stats_range(task, reader='mmap', top=10):
+    path, start, end = task
+    stats = SlowlogStats(top)
+    for entry in parse_entries(_range_lines(path, start, end, reader)):
+        stats.add(entry)
+    return stats
+
+def log_stats(input_files, jobs=1, reader='mmap', top=10):
+    """Aggregate slowlog entries of every input file in a single pass.
+
+    Args:
+        input_files: A list of slowlog file path
+        jobs: Count of processes, 0 means one per CPU
+        reader: 'mmap' or 'stream' for plain files, see iter_lines_mmap
+            and iter_lines
+        top: Count of slowest entries and hot keys to keep
+
+    Return:
+        A SlowlogStats
+
+    """
+    stats = SlowlogStats(top)
+    if jobs == 1:
+        for entry in iter_entries(input_files, reader):
+            stats.add(entry)
+        return stats
+    jobs = jobs or os.cpu_count()
+    tasks = (task for path in input_files for task in split_file(path))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for part in imap_window(pool, functools.partial(_stats_range, reader=reader, top=top), tasks, jobs * 2):
+            stats.merge(part)
+    finally:
+        pool.terminate()
+        pool.join()
+    return stats
+
+def _same_file(path, state):
+    """Whether path is still the file of a saved state."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return (state['dev'], state['inode']) == (st.st_dev, st.st_ino)
+
+def rotation_stem(path):
+    """Get the path of a file before rotation, like 'r.slowlog' of
+    'r.slowlog.1.gz'."""
+    root, ext = os.path.splitext(path)
+    if ext in COMPRESSIONS:
+        path = root
+    return re.sub(r'\.\d+$', '', path)
+
+class Checkpoint(object):
+    """Offsets of input files read so far, for incremental reading.
+
+    Each file is saved as {'dev', 'inode', 'size', 'offset', 'last_id',
+    'last_timestamp'}. A file renamed by rotation keeps its offset by
+    inode, a new inode or a file shorter than its offset is read from
+    the beginning. Entries not newer than the saved last_id and
+    last_timestamp are skipped, they come from overlapping dumps of
+    'slowlog get'. A file compressed by rotation gets a new inode, so a
+    new file takes last_id and last_timestamp of the saved files gone
+    since last run of the same rotation_stem, ids being per node.
+
+    Attributes:
+        path: A path of json file to save offsets, or None to keep them
+            in memory only
+        files: Dict of input file path to its saved state
+
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.files = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)
+
+    def save(self):
+        """Save offsets atomically, files not existing any more are dropped."""
+        self.files = dict((path, state) for path, state in self.files.items() if os.path.exists(path))
+        if not self.path:
+            return
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.files, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _saved_state(self, saved, path, st):
+        state = saved.get(path)
+        if state and (state['dev'], state['inode']) == (st.st_dev, st.st_ino):
+            return state
+        for state in saved.values():
+            if (state['dev'], state['inode']) == (st.st_dev, st.st_ino):
+                return state
+        return None
+
+    def _rotated_state(self, saved, path):
+        """Get a state for a new file, taking what was read of files of
+        the same rotation stem gone or replaced since last run."""
+        state = {'offset': 0, 'size': 0, 'last_id': -1, 'last_timestamp': -1}
+        stem = rotation_stem(path)
+        for gone_path, gone in saved.items():
+            if rotation_stem(gone_path) == stem and not _same_file(gone_path, gone):
+                state['last_id'] = max(state['last_id'], gone['last_id'])
+                state['last_timestamp'] = max(state['last_timestamp'], gone['last_timestamp'])
+        return state
+
+    def _plan(self, saved, path, compression):
+        """Get the range of a file to read in this run.
+
+        The last entry of a plain file is kept for next run if the file
+        was modified in SETTLE_SECONDS, it may be still being written. A
+        compressed file is read as a whole, so it is left for next run
+        until it settles.
+
+        Args:
+            saved: Dict of file path to state saved by last run
+            path: A path of slowlog file
+            compression: Compression of the file, see compression_of
+
+        Return:
+            A tuple of (start, end, new state)
+
+        """
+        st = os.stat(path)
+        state = dict(self._saved_state(saved, path, st) or self._rotated_state(saved, path))
+        if st.st_size < state['offset'] or (compression and st.st_size != state['size']):
+            state['offset'] = 0
+        state.update({'dev': st.st_dev, 'inode': st.st_ino, 'size': st.st_size})
+        start = state['offset']
+        settled = time.time() - st.st_mtime >= SETTLE_SECONDS
+        if compression:
+            end = st.st_size if start == 0 and settled else start
+        elif not settled:
+            end = _last_entry_start(path, start, st.st_size)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(st.st_size - 1 if st.st_size else 0)
+                end = st.st_size if f.read(1) == b'\n' else _last_entry_start(path, start, st.st_size)
+        state['offset'] = end
+        return start, end, state
+
+    def entries(self, input_files, reader='mmap'):
+        """Parse slowlog entries appended to input files since last run.
+
+        State of a file is updated when all its new entries are taken,
+        call save to keep it for next run. A file failing to decompress
+        is read again from the same offset next run, entries already
+        taken are skipped by last_id and last_timestamp.
+
+        Args:
+            input_files: A list of slowlog file path
+            reader: 'mmap' or 'stream' for plain files, see
+                iter_lines_mmap and iter_lines
+
+        Return:
+            A generator of SlowlogEntry
+
+        """
+        saved = dict(self.files)
+        for path in input_files:
+            compression = compression_of(path)
+            start, end, state = self._plan(saved, path, compression)
+            if start < end:
+                last_id, last_timestamp = state['last_id'], state['last_timestamp']
+                try:
+                    for entry in parse_entries(_range_lines(path, start, end, reader)):
+                        if entry.id <= last_id and entry.timestamp <= last_timestamp:
+                            continue
+                        state['last_id'] = max(entry.id, state['last_id'])
+                        state['last_timestamp'] = max(entry.timestamp, state['last_timestamp'])
+                        yield entry
+                except DECOMPRESS_ERRORS:
+                    state['offset'] = start
+            self.files[path] = state
+
 def main():
     opts = argsHandle()
-    input_files = glob.glob(getFileAbspath(opts.input_files))
-    print('\n'.join(log_parser(input_files)))
+    if opts.checkpoint or opts.follow:
+        checkpoint = Checkpoint(opts.checkpoint)
+        while True:
+            input_files = sorted(glob.glob(getFileAbspath(opts.input_files)))
+            entries = checkpoint.entries(input_files, opts.reader)
+            if opts.stats:
+                stats = SlowlogStats(opts.top)
+                for entry in entries:
+                    stats.add(entry)
+                lines = stats.report()
+            else:
+                lines = (format_entry(entry) for entry in entries)
+            for line in lines:
+                sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+            checkpoint.save()
+            if not opts.follow:
+                return
+            time.sleep(opts.interval)
+    input_files = sorted(glob.glob(getFileAbspath(opts.input_files)))
+    if opts.stats:
+        lines = log_stats(input_files, opts.jobs, opts.reader, opts.top).report()
+    else:
+        lines = log_parser(input_files, opts.jobs, opts.reader)
+    for line in lines:
+        sys.stdout.write(line + '\n')
 
 if __name__ == '__main__':
     main()
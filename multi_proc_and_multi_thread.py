@@ -1,97 +1,1147 @@
 #!/usr/bin/env python
 
+import asyncio
+import collections
+import contextlib
+import functools
+import importlib
+import itertools
+import json
+import logging
 import threading
 import multiprocessing
+import multiprocessing.queues
+from multiprocessing import resource_tracker, shared_memory
+import heapq
 import os
+import pickle
+import queue
+import random
+import time
+import zlib
 
-class MyThread(threading.Thread):
-    """docstring for MyThread"""
-    def __init__(self, thread_id, work_queue, msg_for_proc, args):
-        super(MyThread, self).__init__()
-        self.thread_id = thread_id
+MAX_CHUNKSIZE = 1024
+MAX_INFLIGHT = 64 * 1024
+SHM_THRESHOLD = 1024 * 1024
+STEAL_INTERVAL = 0.05
+MAX_JOBS = 1024
+MAX_SAMPLES = 3600
+RETIRE_EXITCODE = 3
+KEY_SLOTS = 1024
+KEY_POLL_INTERVAL = 0.01
+
+logger = logging.getLogger(__name__)
+
+class TaskError(Exception):
+    """Result of a work item whose func raised an exception.
+
+    Attributes:
+        item: The work item
+        error: repr of the exception raised by func
+
+    """
+    def __init__(self, item, error):
+        super(TaskError, self).__init__(item, error)
+        self.item = item
+        self.error = error
+
+    def __str__(self):
+        return 'func(%r) raised %s' % (self.item, self.error)
+
+class SharedPayload(object):
+    """Handle of a work item placed in shared memory by PayloadStore.
+
+    Only the handle goes through the work queue, MyThread attaches the
+    segment and passes a memoryview of it to func.
+
+    Attributes:
+        name: Name of the shared memory segment
+        size: Size of the payload in bytes
+
+    """
+    __slots__ = ('name', 'size')
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __getstate__(self):
+        return self.name, self.size
+
+    def __setstate__(self, state):
+        self.name, self.size = state
+
+    def __repr__(self):
+        return 'SharedPayload(%r, %d)' % (self.name, self.size)
+
+class PayloadStore(object):
+    """Shared memory segments of large work items, reference counted.
+
+    A bytes-like item of at least threshold bytes is copied to a shared
+    memory segment once, the same object submitted again reuses the
+    segment. The segment is unlinked when results of all items using it
+    are back, so items must not be modified after submitted.
+
+    Attributes:
+        threshold: Min size in bytes of items placed in shared memory,
+            None to never place them
+
+    """
+    def __init__(self, threshold=SHM_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._segments = {}
+
+    def wrap(self, item):
+        """Get what to send for an item.
+
+        Args:
+            item: Any work item
+
+        Return:
+            A SharedPayload for a large bytes-like item, else the item
+
+        """
+        if self.threshold is None or not isinstance(item, (bytes, bytearray, memoryview)):
+            return item
+        size = memoryview(item).nbytes
+        if size < self.threshold:
+            return item
+        with self._lock:
+            segment = self._segments.get(id(item))
+            if segment is None:
+                shm = shared_memory.SharedMemory(create=True, size=size)
+                shm.buf[:size] = memoryview(item).cast('B')
+                # The item is kept, so its id is not reused while shared.
+                segment = self._segments[id(item)] = [shm, SharedPayload(shm.name, size), 0, item]
+            segment[2] += 1
+            return segment[1]
+
+    def release(self, item):
+        """Drop one reference of an item wrapped before.
+
+        Args:
+            item: The work item given to wrap
+
+        """
+        with self._lock:
+            segment = self._segments.get(id(item))
+            if segment is None or segment[3] is not item:
+                return
+            segment[2] -= 1
+            if segment[2] == 0:
+                del self._segments[id(item)]
+                segment[0].close()
+                segment[0].unlink()
+
+    def clear(self):
+        """Unlink all segments."""
+        with self._lock:
+            for shm, handle, refs, item in self._segments.values():
+                shm.close()
+                shm.unlink()
+            self._segments = {}
+
+class Metrics(object):
+    """Instrumentation of a MyMaster or MyPool run.
+
+    Consumers count their tasks, errors, wall/CPU time of tasks and time
+    idle waiting for work in plain attributes, no lock is taken, and
+    send them once when they exit. The master samples the depth of the
+    work queue, items in flight and items completed every interval
+    seconds, keeping the last MAX_SAMPLES samples. The mean time an
+    item spends in flight follows from Little's law, mean items in
+    flight over throughput, and the queue wait is that minus the mean
+    wall time of tasks.
+
+    Attributes:
+        started: Time the run started
+        ended: Time the run ended, None while running
+        consumers: A list of stats dicts sent by consumers
+        samples: A deque of (time, queue depth, in flight, completed)
+
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.ended = None
+        self.consumers = []
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+
+    def add_consumer(self, stats):
+        self.consumers.append(stats)
+
+    def sample(self, depth, inflight, completed):
+        self.samples.append((time.time(), depth, inflight, completed))
+
+    def finish(self):
+        self.ended = time.time()
+
+    def to_dict(self):
+        """Aggregate the metrics.
+
+        Return:
+            A dict of totals, per-process and per-consumer stats and
+            samples, ready for json
+
+        """
+        elapsed = (self.ended or time.time()) - self.started
+        keys = ('tasks', 'errors', 'wall', 'cpu', 'idle')
+        total = dict((key, sum(c[key] for c in self.consumers)) for key in keys)
+        total['max_wall'] = max([c['max_wall'] for c in self.consumers] or [0])
+        processes = {}
+        for c in self.consumers:
+            process = processes.setdefault(c['process'], dict((key, 0) for key in keys))
+            for key in keys:
+                process[key] += c[key]
+        for stats in [total] + list(processes.values()) + self.consumers:
+            stats['throughput'] = stats['tasks'] / elapsed if elapsed else 0
+            stats['mean_wall'] = stats['wall'] / stats['tasks'] if stats['tasks'] else 0
+        if self.samples:
+            mean_inflight = sum(sample[2] for sample in self.samples) / float(len(self.samples))
+            total['mean_queue_depth'] = sum(sample[1] or 0 for sample in self.samples) / float(len(self.samples))
+            total['mean_latency'] = mean_inflight / total['throughput'] if total['throughput'] else 0
+            total['mean_queue_wait'] = max(0, total['mean_latency'] - total['mean_wall'])
+        return {
+            'elapsed': elapsed,
+            'total': total,
+            'processes': processes,
+            'consumers': self.consumers,
+            'samples': list(self.samples),
+        }
+
+    def summary(self):
+        """Format an end of run summary.
+
+        Return:
+            A multi-line string
+
+        """
+        metrics = self.to_dict()
+        total = metrics['total']
+        lines = ['%d tasks (%d failed) in %.3fs, %.1f tasks/s, mean %.6fs max %.6fs wall, %.3fs cpu' % (
+            total['tasks'], total['errors'], metrics['elapsed'], total['throughput'], total['mean_wall'],
+            total['max_wall'], total['cpu'])]
+        if 'mean_latency' in total:
+            lines.append('mean queue depth %.1f batches, mean latency %.6fs, mean queue wait %.6fs' % (
+                total['mean_queue_depth'], total['mean_latency'], total['mean_queue_wait']))
+        for process, stats in sorted(metrics['processes'].items()):
+            lines.append('  %s: %d tasks, %.1f tasks/s, %.3fs cpu, %.3fs idle' % (
+                process, stats['tasks'], stats['throughput'], stats['cpu'], stats['idle']))
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """Format the metrics in Prometheus text exposition format.
+
+        Return:
+            A string
+
+        """
+        metrics = self.to_dict()
+        lines = []
+        for name, key, kind in [('worker_tasks_total', 'tasks', 'counter'),
+                                ('worker_task_errors_total', 'errors', 'counter'),
+                                ('worker_task_wall_seconds_total', 'wall', 'counter'),
+                                ('worker_task_cpu_seconds_total', 'cpu', 'counter'),
+                                ('worker_idle_seconds_total', 'idle', 'counter'),
+                                ('worker_throughput_tasks_per_second', 'throughput', 'gauge')]:
+            lines.append('# TYPE %s %s' % (name, kind))
+            for c in metrics['consumers']:
+                lines.append('%s{process="%s",consumer="%s"} %s' % (name, c['process'], c['consumer'], c[key]))
+        if self.samples:
+            sampled_at, depth, inflight, completed = self.samples[-1]
+            for name, value in [('worker_queue_depth', depth), ('worker_inflight', inflight),
+                                ('worker_queue_wait_seconds', metrics['total']['mean_queue_wait'])]:
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, value or 0))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Write the metrics to a file, as json if path ends with .json,
+        else in Prometheus text format.
+
+        Args:
+            path: A path of file
+
+        """
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+class RateLimiter(object):
+    """Token bucket shared by all worker processes.
+
+    The bucket holds up to burst tokens and gains rate tokens a second.
+    Its state lives in shared memory, so the rate holds across all
+    processes and threads. A caller takes a token at once, even into
+    debt, and sleeps until the debt is paid, so callers run in the
+    order they came without polling.
+
+    Attributes:
+        rate: Tokens a second
+        burst: Max count of tokens, default one second of tokens
+
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self._lock = multiprocessing.Lock()
+        # tokens, time of the last update
+        self._state = multiprocessing.Array('d', [self.burst, time.time()], lock=False)
+
+    def reserve(self):
+        """Take a token.
+
+        Return:
+            Seconds to sleep before using it
+
+        """
+        with self._lock:
+            now = time.time()
+            tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate) - 1
+            self._state[0] = tokens
+            self._state[1] = now
+        return max(0, -tokens / self.rate)
+
+class KeyedLimiter(object):
+    """Max count of items running at once per key, across processes.
+
+    Keys are hashed to one of slots counters in shared memory, keys
+    sharing a counter share the limit too. What each owner, a worker
+    process, holds of the counters is kept too, so the counters held by
+    a worker that died, like one retired while an item still ran, are
+    given back by release_owner.
+
+    Attributes:
+        limit: Max count of items of a key running at once
+        slots: Count of counters
+        owners: Count of owners
+        owner: Owner of this process, set by bind
+
+    """
+    def __init__(self, limit, slots=KEY_SLOTS, owners=1):
+        self.limit = limit
+        self.slots = slots
+        self.owners = owners
+        self.owner = 0
+        self._lock = multiprocessing.Lock()
+        self._counts = multiprocessing.Array('i', slots, lock=False)
+        self._held = multiprocessing.Array('i', slots * owners, lock=False)
+
+    def slot(self, key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        return zlib.crc32(key) % self.slots
+
+    def try_acquire(self, slot):
+        with self._lock:
+            if self._counts[slot] >= self.limit:
+                return False
+            self._counts[slot] += 1
+            self._held[self.owner * self.slots + slot] += 1
+            return True
+
+    def release(self, slot):
+        with self._lock:
+            self._counts[slot] -= 1
+            self._held[self.owner * self.slots + slot] -= 1
+
+    def release_owner(self, owner):
+        """Give back all counters held by an owner which is dead."""
+        base = owner * self.slots
+        with self._lock:
+            for slot in range(self.slots):
+                if self._held[base + slot]:
+                    self._counts[slot] -= self._held[base + slot]
+                    self._held[base + slot] = 0
+
+class Throttle(object):
+    """Limits applied by consumers around each call of func.
+
+    Attributes:
+        rate_limiter: A RateLimiter, None for no rate limit
+        key_limiter: A KeyedLimiter, None for no per-key limit
+        key_func: Callable taking the argument of func and returning
+            its key, it must be picklable unless processes are forked
+
+    """
+    def __init__(self, rate=None, burst=None, key_func=None, key_limit=None, slots=KEY_SLOTS, workers=1):
+        self.rate_limiter = RateLimiter(rate, burst) if rate else None
+        self.key_limiter = KeyedLimiter(key_limit, slots, workers) if key_func and key_limit else None
+        self.key_func = key_func
+
+    def bind(self, worker_index):
+        """Tell the limits which worker this process is, in the worker."""
+        if self.key_limiter:
+            self.key_limiter.owner = worker_index
+
+    def release_worker(self, worker_index):
+        """Give back what a dead worker held, before one is started in its place."""
+        if self.key_limiter:
+            self.key_limiter.release_owner(worker_index)
+
+    @contextlib.contextmanager
+    def limit(self, arg):
+        """Wait until arg may run, in a thread."""
+        slot = None
+        if self.key_limiter:
+            slot = self.key_limiter.slot(self.key_func(arg))
+            while not self.key_limiter.try_acquire(slot):
+                time.sleep(KEY_POLL_INTERVAL)
+        try:
+            if self.rate_limiter:
+                time.sleep(self.rate_limiter.reserve())
+            yield
+        finally:
+            if slot is not None:
+                self.key_limiter.release(slot)
+
+    @contextlib.asynccontextmanager
+    async def limit_async(self, arg):
+        """Wait until arg may run, in a coroutine."""
+        slot = None
+        if self.key_limiter:
+            slot = self.key_limiter.slot(self.key_func(arg))
+            while not self.key_limiter.try_acquire(slot):
+                await asyncio.sleep(KEY_POLL_INTERVAL)
+        try:
+            if self.rate_limiter:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            yield
+        finally:
+            if slot is not None:
+                self.key_limiter.release(slot)
+
+def make_throttle(rate_limit=None, rate_burst=None, key_func=None, key_limit=None, workers=1):
+    """Make a Throttle for workers worker processes, None if no limit is given."""
+    if not rate_limit and not (key_func and key_limit):
+        return None
+    return Throttle(rate_limit, rate_burst, key_func, key_limit, workers=workers)
+
+def _raise(error, arg):
+    raise error
+
+def get_unlocked(q, timeout):
+    """Get from a queue, not holding the read lock of a multiprocessing
+    queue while waiting.
+
+    A process killed while holding the lock would leave it held and
+    block all other consumers, waiting on the pipe first leaves the
+    lock held only while a batch is received.
+
+    Args:
+        q: A queue, or StealingQueue
+        timeout: Max seconds to wait
+
+    Raises:
+        queue.Empty: Nothing got in time, or another consumer took it
+
+    """
+    if not isinstance(q, multiprocessing.queues.Queue):
+        return q.get(timeout=timeout)
+    if not q._reader.poll(timeout):
+        raise queue.Empty
+    return q.get_nowait()
+
+@contextlib.contextmanager
+def payload_arg(item):
+    """Get the argument of func for a work item.
+
+    A SharedPayload is attached and given as a memoryview of the shared
+    memory, which is released on exit, other items are given as is.
+
+    Args:
+        item: A work item taken from the work queue
+
+    """
+    if not isinstance(item, SharedPayload):
+        yield item
+        return
+    shm = shared_memory.SharedMemory(name=item.name)
+    view = shm.buf[:item.size]
+    try:
+        yield view
+    finally:
+        view.release()
+        shm.close()
+
+class ConsumerBase(object):
+    """Base of work queue consumers, MyThread and MyAsyncWorker.
+
+    Work items come in batches, lists of (index, item) tuples, and one
+    task_done is called per batch. A None in the queue is the sentinel
+    telling one consumer to exit, master puts one per consumer after the
+    last batch, so consumers never exit while work remains, however
+    long producers take. Gets block for at most poll_interval seconds
+    to check whether the job is aborted or the master is gone.
+
+    A batch of a MyPool job is a (func, items) tuple instead, func is
+    run on its items unless the job flag of the job is set, the index
+    of each item is (job_id, index).
+
+    Results are put to msg_for_proc in batches too, lists of (index, ok,
+    value), ok is False if func raised and value is a TaskError then. A
+    batch of results is sent when it covers about ack_interval seconds
+    of work, measured by the average time of recent items, or before
+    waiting for more work.
+
+    Counters of tasks, errors, wall/CPU time and idle time are kept in
+    plain attributes and sent as ('stats', dict) when the consumer
+    exits, see Metrics.
+
+    With track, the indexes of each batch taken are sent to it as
+    (worker_id, indexes) before the items run, so the master knows the
+    items a dead worker held. It is a multiprocessing.SimpleQueue, its
+    put is done when it returns, not in a feeder thread lost when the
+    process dies. The item running is kept in current as (index, item,
+    started) for the watchdog of MyWorker, and the consumer stops
+    taking work and leaves the rest of its batch when retiring is set.
+
+    A throttle, see Throttle, is waited for before each call of func,
+    the wait is not counted in the time of the item.
+
+    """
+    def _init_consumer(self, work_queue, msg_for_proc, func, flag_for_abort, ack_interval, poll_interval,
+                       job_flags, track=None, throttle=None):
+        self.track = track
+        self.throttle = throttle
+        self.current = None
+        self.retiring = None
         self.work_queue = work_queue
         self.msg_for_proc = msg_for_proc
-        self.args = args
-    
-    def _do_something(self, args):
-        # do something
-        pass
+        self.func = func
+        self.flag_for_abort = flag_for_abort
+        self.job_flags = job_flags
+        self.ack_interval = ack_interval
+        self.poll_interval = poll_interval
+        self.master_pid = None
+        self.item_seconds = None
+        self.started_at = None
+        self.tasks = self.errors = 0
+        self.wall = self.cpu = self.max_wall = self.idle = 0.0
+
+    def _measure(self, elapsed, cpu=0.0):
+        if self.item_seconds is None:
+            self.item_seconds = elapsed
+        else:
+            self.item_seconds += (elapsed - self.item_seconds) * 0.1
+        self.tasks += 1
+        self.wall += elapsed
+        self.cpu += cpu
+        if elapsed > self.max_wall:
+            self.max_wall = elapsed
+
+    def _send_stats(self, consumer, process):
+        self.msg_for_proc.put(('stats', {
+            'consumer': consumer,
+            'process': process,
+            'pid': os.getpid(),
+            'elapsed': time.time() - self.started_at,
+            'tasks': self.tasks,
+            'errors': self.errors,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'max_wall': self.max_wall,
+            'idle': self.idle,
+        }))
+
+    def _announce(self, worker_id, batch):
+        if self.track is not None:
+            self.track.put((worker_id, [index for index, item in batch]))
+
+    def _limit(self, arg):
+        if self.throttle is None:
+            return contextlib.nullcontext()
+        return self.throttle.limit(arg)
+
+    def _limit_async(self, arg):
+        if self.throttle is None:
+            return contextlib.nullcontext()
+        return self.throttle.limit_async(arg)
+
+    def _retiring(self):
+        return self.retiring is not None and self.retiring.is_set()
+
+    def _stopping(self):
+        """Whether to stop taking items: aborted, retiring or orphaned."""
+        return self.flag_for_abort.is_set() or self._retiring() or os.getppid() != self.master_pid
+
+    def _error(self, item, e):
+        self.errors += 1
+        error = TaskError(item, repr(e))
+        try:
+            pickle.dumps(item)
+        except Exception:
+            error.item = repr(item)
+        return error
+
+    def _unpack(self, batch):
+        if not isinstance(batch, tuple):
+            return self.func, batch
+        func, batch = batch
+        if isinstance(func, bytes):
+            try:
+                func = pickle.loads(func)
+            except Exception as e:
+                # Items fail on their own instead of killing the thread.
+                func = functools.partial(_raise, e)
+        return func, batch
+
+    def _cancelled(self, index):
+        return self.job_flags is not None and self.job_flags[index[0] % len(self.job_flags)]
+
+    def _ack_size(self):
+        if not self.item_seconds:
+            return MAX_CHUNKSIZE
+        return max(1, min(MAX_CHUNKSIZE, int(self.ack_interval / self.item_seconds)))
+
+    def _flush(self, results):
+        if results:
+            self.msg_for_proc.put(results)
+        return []
+
+    def _get_batch(self):
+        """Get next batch, None for the sentinel, False if aborted or orphaned."""
+        started = time.time()
+        try:
+            while not self._stopping():
+                try:
+                    return get_unlocked(self.work_queue, self.poll_interval)
+                except queue.Empty:
+                    pass
+            return False
+        finally:
+            self.idle += time.time() - started
+
+class MyThread(threading.Thread, ConsumerBase):
+    """Thread running func on work items of the work queue, see ConsumerBase.
+
+    An item sent as SharedPayload is given to func as a memoryview of
+    the shared memory, func must not keep it after returning.
+
+    Attributes:
+        thread_id: Name of the thread
+        work_queue: multiprocessing.JoinableQueue of work item batches
+        msg_for_proc: multiprocessing.Queue of result batches
+        func: Callable run on each item
+        flag_for_abort: multiprocessing.Event set to stop at once
+        ack_interval: Seconds of work covered by a batch of results
+        poll_interval: Max seconds of a blocking get
+        job_flags: multiprocessing.Array of cancel flags of MyPool jobs
+        track: multiprocessing.SimpleQueue indexes of batches taken are
+            sent to, None to not send them
+        throttle: A Throttle, None for no limits
+
+    """
+    def __init__(self, thread_id, work_queue, msg_for_proc, func, flag_for_abort, ack_interval=0.05,
+                 poll_interval=1, job_flags=None, track=None, throttle=None):
+        super(MyThread, self).__init__()
+        self.thread_id = thread_id
+        self.worker_id = thread_id.split(' ')[0]
+        self._init_consumer(work_queue, msg_for_proc, func, flag_for_abort, ack_interval, poll_interval,
+                            job_flags, track, throttle)
+
+    def _run_func(self, func, index, item, arg):
+        started = time.time()
+        cpu_started = time.thread_time()
+        self.current = (index, item, started)
+        try:
+            return func(arg)
+        finally:
+            self.current = None
+            self._measure(time.time() - started, time.thread_time() - cpu_started)
+
+    def _do_something(self, func, index, item):
+        if self._cancelled(index):
+            return False, TaskError(item, 'job cancelled')
+        try:
+            with payload_arg(item) as arg, self._limit(arg):
+                return True, self._run_func(func, index, item, arg)
+        except Exception as e:
+            return False, self._error(item, e)
 
     def run(self):
-        while not self.work_queue.empty():
-            # do something
-            self._do_something(self.args)
-            self.msg_for_proc.put('sth')
+        self.master_pid = os.getppid()
+        self.started_at = time.time()
+        results = []
+        while True:
+            if self._stopping():
+                break
+            try:
+                batch = self.work_queue.get_nowait()
+            except queue.Empty:
+                results = self._flush(results)
+                batch = self._get_batch()
+            if batch is None:
+                self.work_queue.task_done()
+                break
+            if batch is False:
+                break
+            func, batch = self._unpack(batch)
+            self._announce(self.worker_id, batch)
+            for index, item in batch:
+                if self._stopping():
+                    break
+                ok, value = self._do_something(func, index, item)
+                results.append((index, ok, value))
+                if len(results) >= self._ack_size():
+                    results = self._flush(results)
             self.work_queue.task_done()
+        self._flush(results)
+        self._send_stats(self.thread_id, self.worker_id)
 
 class MyWorker(multiprocessing.Process):
-    """docstring for MyWorker"""
-    def __init__(self, worker_id, work_queue, msg_for_proc, thread_count, flag_for_proc, args):
+    """Process running a pool of MyThread on the shared work queue.
+
+    Attributes:
+        worker_id: Name of the process
+        worker_index: Index of the process in the pool of master, set
+            by make_worker
+        work_queue: multiprocessing.JoinableQueue of work items
+        msg_for_proc: multiprocessing.Queue of results
+        thread_count: Count of threads in the process
+        flag_for_proc: multiprocessing.Event set by master when workers
+            may begin
+        flag_for_abort: multiprocessing.Event set to stop at once
+        func: Callable run on each item
+        ack_interval: Seconds of work covered by a batch of results
+        job_flags: multiprocessing.Array of cancel flags of MyPool jobs
+        task_timeout: Max seconds of an item, None for no limit
+        track: multiprocessing.SimpleQueue threads send indexes of
+            batches taken to, None to not send them
+        throttle: A Throttle shared by threads, None for no limits
+
+    A thread can not be stopped, so when an item runs over task_timeout
+    the process retires: the other threads stop after their current
+    item, a timeout error is sent for the item and the process exits
+    with RETIRE_EXITCODE. The master requeues the rest of its items and
+    starts a new process in its place.
+
+    """
+    def __init__(self, worker_id, work_queue, msg_for_proc, thread_count, flag_for_proc, flag_for_abort, func,
+                 ack_interval=0.05, job_flags=None, task_timeout=None, track=None, throttle=None):
         super(MyWorker, self).__init__()
         self.worker_id = worker_id
+        self.worker_index = 0
         self.work_queue = work_queue
         self.msg_for_proc = msg_for_proc
         self.thread_count = thread_count
         self.flag_for_proc = flag_for_proc
-        self.args = args
+        self.flag_for_abort = flag_for_abort
+        self.func = func
+        self.ack_interval = ack_interval
+        self.job_flags = job_flags
+        self.task_timeout = task_timeout
+        self.track = track
+        self.throttle = throttle
 
     def _start_thread(self, thread_count):
         thread_pool = [
             MyThread('%s thread-%d' % (self.worker_id, i),
                      self.work_queue,
-                     self.msg_for_proc.
-                     self.args
+                     self.msg_for_proc,
+                     self.func,
+                     self.flag_for_abort,
+                     ack_interval=self.ack_interval,
+                     job_flags=self.job_flags,
+                     track=self.track,
+                     throttle=self.throttle
                 )
             for i in range(thread_count)
         ]
-
+        retiring = threading.Event()
         for t in thread_pool:
+            t.retiring = retiring
             t.start()
         return thread_pool
 
-    def _wait_for_finish(self):
-        main_thread = threading.currentThread()
-        for t in threading.enumerate():
-            if t is main_thread:
-                continue
+    def _wait_for_finish(self, thread_pool):
+        for t in thread_pool:
             t.join()
 
+    def _watch(self, thread_pool):
+        interval = min(self.task_timeout / 4.0, 1)
+        while any(t.is_alive() for t in thread_pool):
+            now = time.time()
+            for t in thread_pool:
+                current = t.current
+                if current and now - current[2] > self.task_timeout:
+                    self._retire(thread_pool, t, current)
+            time.sleep(interval)
+
+    def _retire(self, thread_pool, hung, current):
+        hung.retiring.set()
+        # Threads waiting on the work queue hold its lock, let them go
+        # before exiting.
+        for t in thread_pool:
+            if t is not hung:
+                t.join(self.task_timeout)
+        index, item, started = current
+        self.msg_for_proc.put([(index, False, TaskError(item, 'timed out after %ss' % self.task_timeout))])
+        self.msg_for_proc.close()
+        self.msg_for_proc.join_thread()
+        os._exit(RETIRE_EXITCODE)
+
+    def run(self):
+        self.flag_for_proc.wait()
+        if self.throttle is not None:
+            self.throttle.bind(self.worker_index)
+        thread_pool = self._start_thread(self.thread_count)
+        if self.task_timeout:
+            self._watch(thread_pool)
+        self._wait_for_finish(thread_pool)
+
+
+class MyAsyncWorker(multiprocessing.Process, ConsumerBase):
+    """Process running coroutines of func on an asyncio event loop.
+
+    It takes the same work queue as MyWorker, see ConsumerBase, but runs
+    up to concurrency items at once on one event loop instead of a pool
+    of threads, for thousands of I/O-bound items in flight. Batches are
+    taken by a helper thread, and no more than concurrency items are
+    taken ahead of those running.
+
+    Attributes:
+        worker_id: Name of the process
+        worker_index: Index of the process in the pool of master, set
+            by make_worker
+        work_queue: multiprocessing.JoinableQueue of work items
+        msg_for_proc: multiprocessing.Queue of results
+        concurrency: Max count of items running at once
+        flag_for_proc: multiprocessing.Event set by master when workers
+            may begin
+        flag_for_abort: multiprocessing.Event set to stop at once
+        func: Coroutine function run on each item
+        ack_interval: Seconds of work covered by a batch of results
+        job_flags: multiprocessing.Array of cancel flags of MyPool jobs
+        task_timeout: Max seconds of an item, the coroutine is cancelled
+            after it, None for no limit
+        track: multiprocessing.SimpleQueue indexes of batches taken are
+            sent to, None to not send them
+        throttle: A Throttle, None for no limits
+
+    """
+    def __init__(self, worker_id, work_queue, msg_for_proc, concurrency, flag_for_proc, flag_for_abort, func,
+                 ack_interval=0.05, job_flags=None, poll_interval=1, task_timeout=None, track=None,
+                 throttle=None):
+        multiprocessing.Process.__init__(self)
+        self.worker_id = worker_id
+        self.worker_index = 0
+        self.concurrency = concurrency
+        self.flag_for_proc = flag_for_proc
+        self.task_timeout = task_timeout
+        self._init_consumer(work_queue, msg_for_proc, func, flag_for_abort, ack_interval, poll_interval,
+                            job_flags, track, throttle)
+        self._results = []
+
+    async def _do_something(self, func, index, item, semaphore):
+        started = time.time()
+        try:
+            if self._cancelled(index):
+                raise TaskError(item, 'job cancelled')
+            with payload_arg(item) as arg:
+                async with self._limit_async(arg):
+                    started = time.time()
+                    running = func(arg)
+                    if self.task_timeout:
+                        running = asyncio.wait_for(running, self.task_timeout)
+                    result = True, await running
+        except TaskError as e:
+            result = False, e
+        except asyncio.TimeoutError:
+            self.errors += 1
+            result = False, TaskError(item, 'timed out after %ss' % self.task_timeout)
+        except Exception as e:
+            result = False, self._error(item, e)
+        finally:
+            semaphore.release()
+            self._measure(time.time() - started)
+        self._results.append((index,) + result)
+        if len(self._results) >= self._ack_size():
+            self._results = self._flush(self._results)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.ack_interval)
+            self._results = self._flush(self._results)
+
+    async def _run_loop(self):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        flusher = loop.create_task(self._flush_periodically())
+        batches = []
+        while True:
+            batch = await loop.run_in_executor(None, self._get_batch)
+            if not batch:
+                break
+            tasks = []
+            func, batch = self._unpack(batch)
+            self._announce(self.worker_id, batch)
+            for index, item in batch:
+                if self._stopping():
+                    break
+                await semaphore.acquire()
+                tasks.append(loop.create_task(self._do_something(func, index, item, semaphore)))
+            batches.append(asyncio.gather(*tasks))
+            batches[-1].add_done_callback(lambda f: self.work_queue.task_done())
+            batches = [b for b in batches if not b.done()]
+        if batches:
+            await asyncio.wait(batches)
+        flusher.cancel()
+        self._results = self._flush(self._results)
+        if batch is None:
+            self.work_queue.task_done()
+
     def run(self):
-        if self.flag_for_proc.is_set() is not True:
-            #do somthing
-            pass
-        self._start_thread(self.thread_count)
-        self._wait_for_finish()
-        
+        self.master_pid = os.getppid()
+        self.flag_for_proc.wait()
+        if self.throttle is not None:
+            self.throttle.bind(self.worker_index)
+        self.started_at = time.time()
+        asyncio.run(self._run_loop())
+        # Coroutines interleave, so CPU time is only known per process.
+        self.cpu = time.process_time()
+        self._send_stats(self.worker_id, self.worker_id)
+
+
+def alpha_order(indexed):
+    """Keep work items in the order they are submitted."""
+    return indexed
+
+def shuffle_order(indexed):
+    """Shuffle work items, so slow ones are not all together."""
+    indexed = list(indexed)
+    random.shuffle(indexed)
+    return indexed
+
+ORDER_POLICIES = {'alpha': alpha_order, 'shuffle': shuffle_order}
+
+class StealingQueue(object):
+    """Work queue of one worker of WorkStealingScheduler.
+
+    It has the get/get_nowait/task_done methods consumers use on a
+    JoinableQueue. Batches come from the local queue of the worker
+    first; when it is empty, a batch is stolen from a peer, tried in
+    random order. A sentinel is only returned when no peer has work
+    left, a sentinel stolen from a peer is put back.
+
+    Attributes:
+        local: multiprocessing.Queue of this worker
+        peers: multiprocessing.Queue of the other workers
+
+    """
+    def __init__(self, local, peers):
+        self.local = local
+        self.peers = peers
+
+    def steal(self):
+        """Take a batch from a peer.
+
+        Return:
+            A batch of work items
+
+        Raises:
+            queue.Empty: No peer has a batch
+
+        """
+        for peer in random.sample(self.peers, len(self.peers)):
+            try:
+                batch = peer.get_nowait()
+            except queue.Empty:
+                continue
+            if batch is None:
+                peer.put(None)
+                continue
+            return batch
+        raise queue.Empty
+
+    def _local_batch(self, batch):
+        if batch is None:
+            try:
+                stolen = self.steal()
+            except queue.Empty:
+                return None
+            self.local.put(None)
+            return stolen
+        return batch
+
+    def get_nowait(self):
+        return self._local_batch(self.local.get_nowait())
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                return self.steal()
+            except queue.Empty:
+                pass
+            wait = STEAL_INTERVAL if deadline is None else min(STEAL_INTERVAL, deadline - time.time())
+            if wait <= 0:
+                raise queue.Empty
+            try:
+                return self._local_batch(get_unlocked(self.local, wait))
+            except queue.Empty:
+                pass
+
+    def task_done(self):
+        pass
+
+class SharedQueueScheduler(object):
+    """All workers take work from one JoinableQueue.
+
+    Attributes:
+        queue: multiprocessing.JoinableQueue of batches
+
+    """
+    def __init__(self, proc_count):
+        self.queue = multiprocessing.JoinableQueue()
+
+    def worker_queue(self, worker_index):
+        return self.queue
+
+    def qsize(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def put(self, batch):
+        self.queue.put(batch)
+
+    def put_sentinel(self, consumers):
+        for _ in range(consumers):
+            self.queue.put(None)
+
+class WorkStealingScheduler(object):
+    """Each worker has a local queue and steals from peers when it is empty.
+
+    Batches are dealt to local queues round-robin, so workers do not
+    contend on one lock, and a worker done with its own share takes
+    batches of the slow ones instead of idling.
+
+    Attributes:
+        queues: A list of multiprocessing.Queue, one per worker
+
+    """
+    def __init__(self, proc_count):
+        self.queues = [multiprocessing.Queue() for _ in range(proc_count)]
+        self._next = 0
+
+    def worker_queue(self, worker_index):
+        peers = self.queues[:worker_index] + self.queues[worker_index + 1:]
+        return StealingQueue(self.queues[worker_index], peers)
+
+    def qsize(self):
+        try:
+            return sum(q.qsize() for q in self.queues)
+        except NotImplementedError:
+            return None
+
+    def put(self, batch):
+        self.queues[self._next].put(batch)
+        self._next = (self._next + 1) % len(self.queues)
+
+    def put_sentinel(self, consumers):
+        per_worker = consumers // len(self.queues)
+        for q in self.queues:
+            for _ in range(per_worker):
+                q.put(None)
+
+SCHEDULERS = {'shared': SharedQueueScheduler, 'stealing': WorkStealingScheduler}
 
 class ProcBase(object):
-    """docstring for ProcBase"""
-    def __init__(self, arg):
+    """Base of masters, it makes queues and starts MyWorker processes.
+
+    Attributes:
+        order: Policy ordering work items before they are put, 'alpha'
+            to keep the given order, 'shuffle', or a callable taking and
+            returning a list of (index, item) tuples
+        flag_for_proc: multiprocessing.Event to tell MyWorker processes
+            they may begin
+        flag_for_abort: multiprocessing.Event to tell MyWorker processes
+            to stop at once
+        flag_for_thread: threading.Event for threads of the master
+
+    """
+    def __init__(self, order='alpha'):
         super(ProcBase, self).__init__()
-        self.arg = arg
+        self.order = order
         self.flag_for_proc = multiprocessing.Event()
+        self.flag_for_abort = multiprocessing.Event()
         self.flag_for_thread = threading.Event()
 
+    def apply_order(self, indexed):
+        """Order work items by the order policy.
 
-    def some_methor(self, args):
-        # do something
-        pass
+        Args:
+            indexed: A list of (index, item) tuples
+
+        Return:
+            The list in the order to put to the work queue
+
+        """
+        if callable(self.order):
+            return self.order(indexed)
+        return ORDER_POLICIES.get(self.order, shuffle_order)(indexed)
+
+    def get_scheduler(self, kind, proc_count):
+        """Make a scheduler distributing work to workers.
+
+        Args:
+            kind: 'shared' for SharedQueueScheduler, 'stealing' for
+                WorkStealingScheduler
+            proc_count: Count of worker processes
 
-    def get_work_queue(self, w_list):
-        q = multiprocessing.JoinableQueue()
-        if order != 'alpha':
-            shuffle(w_list)
-        for i in w_list:
-            q.put(i)
-        return q
+        Return:
+            A scheduler
+
+        """
+        return SCHEDULERS[kind](proc_count)
+
+    def _read_taken(self):
+        # Items are taken before their results are sent, and before the
+        # worker could die.
+        while not self._taken.empty():
+            worker_id, indexes = self._taken.get()
+            for index in indexes:
+                self._owners[index] = worker_id
+
+    def _acquire(self, semaphore):
+        while not semaphore.acquire(timeout=self.poll_interval):
+            if self.flag_for_abort.is_set():
+                return False
+        return True
+
+    def _acquire_many(self, semaphore, count):
+        for _ in range(count):
+            if not self._acquire(semaphore):
+                return False
+        return True
 
     def get_msg_for_proc_like_list(self):
-        return q = multiprocessing.Queue()
+        return multiprocessing.Queue()
 
     def get_msg_for_proc_like_dict(self, *keys):
+        """Make per-key result queues.
+
+        They live in the master only, results are routed to them by the
+        collector thread, so they are plain queue.Queue.
+
+        Args:
+            keys: Keys of results
+
+        Return:
+            A dict of key to queue.Queue
+
+        """
         q_dict = {}
         for k in keys:
-            q_dict[k] = multiprocessing.Queue()
+            q_dict[k] = queue.Queue()
         return q_dict
 
     def set_proc_flag(self):
@@ -100,15 +1150,100 @@ class ProcBase(object):
     def set_thread_flag(self):
         self.flag_for_thread.set()
 
-    def start_worker(self, proc_count, thread_count, work_queue, msg_for_proc, args):
-        worker_pool = [
-            MyWorker('proc-%d' % i,
-                     work_queue,
-                     msg_for_proc,
-                     thread_count,
-                     self.flag_for_proc,
-                     args
+    def set_abort_flag(self):
+        self.flag_for_abort.set()
+
+    def start_sampler(self, metrics, interval, probe, stop):
+        """Start a daemon thread sampling queues into metrics until stop is set.
+
+        Args:
+            metrics: A Metrics
+            interval: Seconds between samples
+            probe: Callable returning (queue depth, in flight, completed)
+            stop: threading.Event
+
+        Return:
+            The started thread
+
+        """
+        def sample():
+            while not stop.wait(interval):
+                metrics.sample(*probe())
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+        return sampler
+
+    def collect_stats(self, msg_for_proc, worker_pool, metrics, consumers):
+        """Take stats of consumers left after the last result.
+
+        Gives up when all workers are gone, a killed worker sends none.
+
+        Args:
+            msg_for_proc: A queue for results
+            worker_pool: A list of worker processes
+            metrics: A Metrics the stats are added to
+            consumers: Count of consumers expected
+
+        """
+        while len(metrics.consumers) < consumers and not self.flag_for_abort.is_set():
+            try:
+                message = msg_for_proc.get(timeout=0.1)
+            except queue.Empty:
+                if not any(w.is_alive() for w in worker_pool):
+                    break
+                continue
+            if isinstance(message, tuple) and message[0] == 'stats':
+                metrics.add_consumer(message[1])
+
+    def make_worker(self, worker_index, thread_count, work_queue, msg_for_proc, func, ack_interval=0.05,
+                    worker_type='thread', job_flags=None, task_timeout=None, track=None, throttle=None):
+        """Make a worker process, see start_worker."""
+        worker_class = MyAsyncWorker if worker_type == 'asyncio' else MyWorker
+        worker = worker_class('proc-%d' % worker_index,
+                            work_queue.worker_queue(worker_index) if hasattr(work_queue, 'worker_queue')
+                            else work_queue,
+                            msg_for_proc,
+                            thread_count,
+                            self.flag_for_proc,
+                            self.flag_for_abort,
+                            func,
+                            ack_interval,
+                            job_flags,
+                            task_timeout=task_timeout,
+                            track=track,
+                            throttle=throttle
                 )
+        worker.worker_index = worker_index
+        return worker
+
+    def start_worker(self, proc_count, thread_count, work_queue, msg_for_proc, func, ack_interval=0.05,
+                     worker_type='thread', job_flags=None, task_timeout=None, track=None, throttle=None):
+        """Start worker processes.
+
+        Args:
+            proc_count: Count of processes
+            thread_count: Count of MyThread in each MyWorker, or max
+                count of running items in each MyAsyncWorker
+            work_queue: A scheduler made by get_scheduler
+            msg_for_proc: A queue for results
+            func: Callable run on each item, a coroutine function for
+                'asyncio' workers
+            ack_interval: Seconds of work covered by a batch of results
+            worker_type: 'thread' for MyWorker, 'asyncio' for MyAsyncWorker
+            job_flags: multiprocessing.Array of cancel flags of MyPool jobs
+            task_timeout: Max seconds of an item, None for no limit
+            track: multiprocessing.SimpleQueue workers send indexes of
+                batches taken to, None to not send them
+            throttle: A Throttle shared by workers, None for no limits
+
+        Return:
+            A list of started processes
+
+        """
+        worker_pool = [
+            self.make_worker(i, thread_count, work_queue, msg_for_proc, func, ack_interval, worker_type,
+                             job_flags, task_timeout, track, throttle)
             for i in range(proc_count)
         ]
         for w in worker_pool:
@@ -117,37 +1252,782 @@ class ProcBase(object):
 
 
 class MyMaster(multiprocessing.Process, ProcBase):
-    """docstring for MyMaster"""
-    def __init__(self, w_list, args):
+    """Master running func on work items by proc_count x thread_count threads.
+
+    Call execute to get results in the current process, or start it as
+    a process and handle results by callback. For work produced while
+    running, call begin, then submit from any thread as work comes and
+    end_submit after the last, and take results by iter_results.
+
+    Work items are taken from w_list, or the iterable given to submit,
+    lazily, and at most max_inflight items are submitted but without a
+    result, submit blocks beyond that. A generator of any length is so
+    run in flat memory, and workers start on the first items at once.
+
+    A collector thread drains results of workers as soon as they come,
+    so workers never block on a full pipe. Results are unordered by
+    default. With ordered, they come in the order of submission and at
+    most reorder_buffer items are submitted but not yet taken, submit
+    blocks beyond that, so take results in another thread then. With
+    result_keys, func returns (key, value) and results of those keys
+    go to per-key queues taken by iter_results(key=key).
+
+    A failed item is run again up to retries times, after retry_backoff
+    seconds doubled on each attempt. Workers tell the master the items
+    they take; when a worker process dies, its items are put back, which
+    counts as an attempt unless the worker retired after a task_timeout,
+    and with respawn a new worker is started in its place. Items may so
+    run more than once, only the first result is kept. A worker killed
+    while receiving a batch may leave the lock of the work queue held,
+    there is no recovery from that, see get_unlocked.
+
+    Attributes:
+        w_list: Any iterable of work items for execute
+        func: Callable run on each item in MyThread, it must be
+            picklable unless processes are forked
+        proc_count: Count of MyWorker processes, default one per CPU
+        thread_count: Count of MyThread in each process, or max count of
+            running items in each process for 'asyncio' workers
+        callback: Callable run in master with (item, result) of each
+            item, used when started as a process
+        chunksize: Count of work items sent to a thread at once,
+            default about a quarter of an even share of each thread
+        ack_interval: Seconds of work covered by a batch of results
+        poll_interval: Max seconds of a blocking get on queues
+        ordered: Whether iter_results follows the order of submission
+        reorder_buffer: Max count of items submitted but not taken in
+            ordered mode, None for no limit
+        result_keys: Keys of per-key result queues
+        shm_threshold: Min size in bytes of bytes-like work items sent
+            through shared memory instead of the pipe, None to never,
+            see PayloadStore
+        worker_type: 'thread' for MyWorker processes running pools of
+            MyThread, 'asyncio' for MyAsyncWorker processes running
+            func as coroutines
+        scheduler: 'shared' for one work queue taken by all workers,
+            'stealing' for a local queue per worker and work stealing,
+            see WorkStealingScheduler
+        metrics_interval: Seconds between samples of queue depth, None
+            to never sample
+        metrics_file: Path the metrics are exported to by wait, see
+            Metrics.export
+        metrics: Metrics of the run, summarized to the log by wait
+        retries: Max count of runs of an item after the first
+        retry_backoff: Seconds before the first retry of an item
+        task_timeout: Max seconds of an item, None for no limit
+        respawn: Whether to start a new worker when one dies
+        max_inflight: Max count of items submitted but without a
+            result, None for no limit
+        throttle: A Throttle made of rate_limit, calls of func a second
+            by all workers, rate_burst, and key_limit, max count of
+            items of a key from key_func running at once, None if no
+            limit is given
+
+    """
+    def __init__(self, w_list, func, proc_count=None, thread_count=4, order='alpha', callback=None,
+                 chunksize=None, ack_interval=0.05, poll_interval=1, ordered=False, reorder_buffer=None,
+                 result_keys=(), shm_threshold=SHM_THRESHOLD, worker_type='thread',
+                 scheduler='shared', metrics_interval=1, metrics_file=None, retries=0, retry_backoff=0.1,
+                 task_timeout=None, respawn=True, max_inflight=MAX_INFLIGHT, rate_limit=None, rate_burst=None,
+                 key_func=None, key_limit=None):
         multiprocessing.Process.__init__(self)
-        JobBase.__init__(self)
-        self.arg = args
-        self.proc_count = x
-        self.thread_count = y
-        self.work_queue = self.get_work_queue(w_list)
-        self.msg_for_proc = self.get_msg_for_proc_like_list()
-        
-    def _do_something(self, args):
-        # do something
-        pass
+        ProcBase.__init__(self, order)
+        if ordered and result_keys:
+            raise ValueError('ordered results can not be routed by key')
+        self.w_list = w_list
+        self.func = func
+        self.proc_count = proc_count or multiprocessing.cpu_count()
+        self.thread_count = thread_count
+        self.callback = callback
+        self.chunksize = chunksize
+        self.ack_interval = ack_interval
+        self.poll_interval = poll_interval
+        self.ordered = ordered
+        self.reorder_buffer = reorder_buffer
+        self.result_keys = result_keys
+        self.worker_type = worker_type
+        self.scheduler = scheduler
+        self.work_queue = None
+        self.msg_for_proc = None
+        self.worker_pool = []
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._inflight = {}
+        self._results = queue.Queue()
+        self._keyed_results = self.get_msg_for_proc_like_dict(*result_keys)
+        self._window = threading.Semaphore(reorder_buffer) if ordered and reorder_buffer else None
+        self._payloads = PayloadStore(shm_threshold)
+        self._collector = None
+        self.metrics_interval = metrics_interval
+        self.metrics_file = metrics_file
+        self.metrics = None
+        self._completed = 0
+        self._sampling_done = threading.Event()
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.task_timeout = task_timeout
+        self.respawn = respawn
+        self._attempts = {}
+        self._owners = {}
+        self._retry_due = []
+        self._reaped = set()
+        self._taken = None
+        self.max_inflight = max_inflight
+        self._slots = threading.Semaphore(max_inflight) if max_inflight else None
+        self.throttle = make_throttle(rate_limit, rate_burst, key_func, key_limit, self.proc_count)
 
-    def run(self):
-        worker_pool = self.start_worker(self.proc_count, self.thread_count, self.work_queue, self.msg_for_proc, self.args)
-        # do something
+    def _chunksize(self, count):
+        """Count of items in a batch, count is None if the count of items is
+        not known, the batch is then sized by max_inflight."""
+        if count is None:
+            count = self.max_inflight or 0
+        if self.chunksize:
+            chunksize = self.chunksize
+        else:
+            chunksize = max(1, min(MAX_CHUNKSIZE, count // (self.proc_count * self.thread_count * 4)))
+        if self._window:
+            chunksize = min(chunksize, self.reorder_buffer)
+        if self.max_inflight:
+            # Leave a batch for every consumer.
+            chunksize = max(1, min(chunksize, self.max_inflight // self._consumers()))
+        return chunksize
+
+    def begin(self):
+        """Start MyWorker processes and the collector thread."""
+        # Workers share the resource tracker of master, so segments they
+        # attach are not unlinked when they exit.
+        resource_tracker.ensure_running()
+        self.work_queue = self.get_scheduler(self.scheduler, self.proc_count)
+        self.msg_for_proc = self.get_msg_for_proc_like_list()
+        self._taken = multiprocessing.SimpleQueue()
+        self.worker_pool = self.start_worker(self.proc_count, self.thread_count, self.work_queue,
+                                             self.msg_for_proc, self.func, self.ack_interval, self.worker_type,
+                                             task_timeout=self.task_timeout, track=self._taken,
+                                             throttle=self.throttle)
+        self.metrics = Metrics()
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+        if self.metrics_interval:
+            self.start_sampler(self.metrics, self.metrics_interval, self._probe, self._sampling_done)
         self.set_proc_flag()
-        self.work_queue.join()
-        for w in worker_pool:
+
+    def _consumers(self):
+        return self.proc_count if self.worker_type == 'asyncio' else self.proc_count * self.thread_count
+
+    def _probe(self):
+        with self._lock:
+            return self.work_queue.qsize(), len(self._inflight), self._completed
+
+    def _put_batch(self, batch):
+        if self._slots and not self._acquire_many(self._slots, len(batch)):
+            return
+        with self._lock:
+            self._inflight.update(batch)
+        self.work_queue.put([(index, self._payloads.wrap(item)) for index, item in batch])
+
+    def submit(self, w_list):
+        """Submit work items, they are indexed after the items submitted before.
+
+        Items are taken a batch for each consumer at a time, the order
+        policy applies within those, and it blocks while max_inflight
+        items are without a result. In ordered mode with reorder_buffer,
+        at most reorder_buffer items are taken at a time, and the window
+        is taken for all of them before they are ordered, so the next
+        item to be taken by iter_results is always submitted.
+
+        Args:
+            w_list: Any iterable of work items
+
+        """
+        chunksize = self._chunksize(len(w_list) if hasattr(w_list, '__len__') else None)
+        group_size = chunksize * self._consumers()
+        if self._window:
+            group_size = min(group_size, self.reorder_buffer)
+        items = iter(w_list)
+        while not self.flag_for_abort.is_set():
+            group = list(itertools.islice(items, group_size))
+            with self._lock:
+                if self.flag_for_thread.is_set():
+                    raise ValueError('submit after end_submit')
+                start = self._submitted
+                self._submitted += len(group)
+            if not group:
+                return
+            if self._window and not self._acquire_many(self._window, len(group)):
+                return
+            indexed = self.apply_order(list(enumerate(group, start)))
+            for i in range(0, len(indexed), chunksize):
+                self._put_batch(indexed[i:i + chunksize])
+
+    def end_submit(self):
+        """Tell workers no more work will be submitted, they exit when all
+        results are back, as failed items may be put again."""
+        with self._lock:
+            self.set_thread_flag()
+
+    def _done(self):
+        with self._lock:
+            return self.flag_for_thread.is_set() and self._completed >= self._submitted
+
+    def _collect(self):
+        checked = time.time()
+        while not self._done() and not self.flag_for_abort.is_set():
+            timeout = self.poll_interval
+            if self._retry_due:
+                timeout = max(0, min(timeout, self._retry_due[0][0] - time.time()))
+            try:
+                batch = self.msg_for_proc.get(timeout=timeout)
+            except queue.Empty:
+                batch = None
+            self._read_taken()
+            if isinstance(batch, tuple):
+                self.metrics.add_consumer(batch[1])
+            elif batch:
+                for index, ok, value in batch:
+                    self._owners.pop(index, None)
+                    if not ok and index in self._inflight and self._attempt(index):
+                        delay = self.retry_backoff * 2 ** (self._attempts[index] - 1)
+                        heapq.heappush(self._retry_due, (time.time() + delay, index))
+                        continue
+                    self._deliver(index, ok, value)
+            while self._retry_due and self._retry_due[0][0] <= time.time():
+                self._requeue([heapq.heappop(self._retry_due)[1]])
+            if time.time() - checked >= self.poll_interval:
+                checked = time.time()
+                self._reap()
+                # Owners of items taken and done before they were read.
+                with self._lock:
+                    for index in [index for index in self._owners if index not in self._inflight]:
+                        del self._owners[index]
+        self.work_queue.put_sentinel(self._consumers())
+        self._payloads.clear()
+        for q in [self._results] + list(self._keyed_results.values()):
+            q.put(None)
+        self.collect_stats(self.msg_for_proc, self.worker_pool, self.metrics, self._consumers())
+        self._sampling_done.set()
+        self.metrics.finish()
+
+    def _attempt(self, index):
+        """Count a failed run of an item.
+
+        Return:
+            True if a retry is left
+
+        """
+        attempts = self._attempts.get(index, 0) + 1
+        if attempts > self.retries:
+            return False
+        self._attempts[index] = attempts
+        return True
+
+    def _requeue(self, indexes):
+        with self._lock:
+            items = [(index, self._inflight[index]) for index in indexes if index in self._inflight]
+        if items:
+            self.work_queue.put([(index, self._payloads.wrap(item)) for index, item in items])
+            for index, item in items:
+                self._payloads.release(item)
+
+    def _deliver(self, index, ok, value):
+        with self._lock:
+            if index not in self._inflight:
+                # Late result of an item run again.
+                return
+            item = self._inflight.pop(index)
+            self._completed += 1
+        if self._slots:
+            self._slots.release()
+        self._attempts.pop(index, None)
+        self._payloads.release(item)
+        if ok and self._keyed_results and isinstance(value, tuple) and len(value) == 2 \
+                and value[0] in self._keyed_results:
+            self._keyed_results[value[0]].put((index, item, value[1]))
+        else:
+            self._results.put((index, item, value))
+
+    def _reap(self):
+        """Put back items of dead workers and start new workers in their place."""
+        for i, w in enumerate(self.worker_pool):
+            if w.exitcode in (None, 0) or w in self._reaped:
+                continue
+            self._reaped.add(w)
+            if self.throttle is not None:
+                self.throttle.release_worker(i)
+            self._read_taken()
+            lost = [index for index, owner in self._owners.items() if owner == w.worker_id]
+            logger.warning('%s exited with code %s holding %d items', w.worker_id, w.exitcode, len(lost))
+            again = []
+            for index in lost:
+                del self._owners[index]
+                if w.exitcode == RETIRE_EXITCODE or self._attempt(index):
+                    again.append(index)
+                else:
+                    error = 'worker %s died with exit code %s' % (w.worker_id, w.exitcode)
+                    self._deliver(index, False, TaskError(self._inflight.get(index), error))
+            self._requeue(again)
+            if self.respawn and not self._done():
+                self.worker_pool[i] = self.make_worker(i, self.thread_count, self.work_queue, self.msg_for_proc,
+                                                       self.func, self.ack_interval, self.worker_type,
+                                                       task_timeout=self.task_timeout, track=self._taken,
+                                                       throttle=self.throttle)
+                self.worker_pool[i].start()
+        if not self.respawn and not any(w.is_alive() for w in self.worker_pool):
+            with self._lock:
+                left = list(self._inflight.items())
+            for index, item in left:
+                self._deliver(index, False, TaskError(item, 'no worker left'))
+
+    def _iter_queue(self, q):
+        while True:
+            result = q.get()
+            if result is None:
+                q.put(None)
+                return
+            yield result
+
+    def _iter_ordered(self, q):
+        pending = []
+        next_index = 0
+        for result in self._iter_queue(q):
+            heapq.heappush(pending, result)
+            while pending and pending[0][0] == next_index:
+                yield heapq.heappop(pending)
+                next_index += 1
+                if self._window:
+                    self._window.release()
+
+    def iter_results(self, key=None):
+        """Get results until end_submit and all results are taken.
+
+        Args:
+            key: Take results routed to this key of result_keys, None
+                for the others
+
+        Return:
+            A generator of (index, result) tuples, the result of a
+            failed item is a TaskError
+
+        """
+        if key is not None:
+            results = self._iter_queue(self._keyed_results[key])
+        elif self.ordered:
+            results = self._iter_ordered(self._results)
+        else:
+            results = self._iter_queue(self._results)
+        for index, item, value in results:
+            if self.callback:
+                self.callback(item, value)
+            yield index, value
+
+    def wait(self):
+        """Wait for MyWorker processes and the collector thread to exit,
+        then log a summary of metrics and export them to metrics_file."""
+        # Dead workers are replaced until the collector is done.
+        self._collector.join()
+        for w in self.worker_pool:
             w.join()
+        logger.info('%s', self.metrics.summary())
+        if self.metrics_file:
+            self.metrics.export(self.metrics_file)
+
+    def abort(self):
+        """Stop MyWorker processes at once, work not done is dropped."""
+        self.set_abort_flag()
+        self.wait()
+
+    def execute(self):
+        """Run func on all work items and wait for the results.
+
+        Return:
+            A list of results in the order of w_list, the result of a
+            failed item is a TaskError, results routed by key are not
+            in the list
+
+        """
+        self.begin()
+        feeder = threading.Thread(target=self._submit_all)
+        feeder.start()
+        results = []
+        for index, value in self.iter_results():
+            if index >= len(results):
+                results.extend([None] * (index + 1 - len(results)))
+            results[index] = value
+        feeder.join()
+        self.wait()
+        return results
+
+    def _submit_all(self):
+        self.submit(self.w_list)
+        self.end_submit()
+
+    def run(self):
+        self.execute()
 
 class SuperMaster(multiprocessing.Process):
-    """docstring for SuperMaster"""
-    def __init__(self, w_list, arg):
+    """Process starting a MyMaster and exiting at once.
+
+    The MyMaster is orphaned, so the caller does not wait for it.
+
+    Attributes:
+        w_list: Any iterable of work items
+        func: Callable run on each item
+        kwargs: Other arguments of MyMaster
+
+    """
+    def __init__(self, w_list, func, **kwargs):
         super(SuperMaster, self).__init__()
-        self.arg = arg
         self.w_list = w_list
-        
+        self.func = func
+        self.kwargs = kwargs
+
     def run(self):
-        master = MyMaster(self.w_list, self.arg)
+        master = MyMaster(self.w_list, self.func, **self.kwargs)
         master.start()
         # pid 1 will wait for finish
         os._exit(0)
+
+class Job(object):
+    """A job submitted to MyPool.
+
+    Attributes:
+        job_id: Id of the job in the pool
+        func: Callable run on each item
+        count: Count of work items, None until all are submitted
+        received: Count of results received
+        done: threading.Event set when all results are received
+
+    """
+    def __init__(self, pool, job_id, func, count):
+        self.pool = pool
+        self.job_id = job_id
+        self.func = func
+        self.count = count
+        self.received = 0
+        self.done = threading.Event()
+        self._results = queue.Queue()
+        self._inflight = {}
+
+    def _finish(self):
+        self._results.put(None)
+        self.done.set()
+
+    def iter_results(self):
+        """Get results as they come, until all results are taken.
+
+        Return:
+            A generator of (index, result) tuples, index is the
+            position of item in the job, the result of a failed or
+            cancelled item is a TaskError
+
+        """
+        while True:
+            result = self._results.get()
+            if result is None:
+                self._results.put(None)
+                return
+            yield result
+
+    def results(self):
+        """Wait for the job to finish.
+
+        Return:
+            A list of results in the order of work items
+
+        """
+        results = [None] * self.count
+        for index, value in self.iter_results():
+            results[index] = value
+        return results
+
+    def cancel(self):
+        """Skip items of the job not started yet, they fail as cancelled."""
+        self.pool.job_flags[self.job_id % MAX_JOBS] = 1
+
+class MyPool(ProcBase):
+    """Long-lived pool of worker processes running successive jobs.
+
+    Workers are started once by start and stay warm between jobs, each
+    submit_job sends a func with its work items, batches carry the func
+    and the results are routed back to the Job by a collector thread.
+    Jobs may overlap. Each job has a cancel flag in job_flags, shared
+    with the workers, instead of the single flag_for_proc of MyMaster.
+
+    Modules listed in preload are imported before workers are forked,
+    so jobs do not pay for importing them in every worker.
+
+    Workers tell the pool the items they take; when a worker process
+    dies, like killed for memory, its items fail with a TaskError and a
+    new worker is started in its place, so jobs always finish.
+
+    Work items of a job are taken lazily, and at most max_inflight items
+    of all jobs are submitted but without a result, submit_job blocks
+    beyond that, see MyMaster.
+
+    Attributes:
+        proc_count: Count of worker processes, default one per CPU
+        thread_count: Count of MyThread in each process, or max count
+            of running items in each process for 'asyncio' workers
+        chunksize: Count of work items sent to a thread at once,
+            default about a quarter of an even share of each thread
+        ack_interval: Seconds of work covered by a batch of results
+        poll_interval: Max seconds of a blocking get on queues
+        worker_type: 'thread' or 'asyncio', see MyMaster
+        scheduler: 'shared' or 'stealing', see MyMaster
+        preload: A list of module names imported before fork
+        job_flags: multiprocessing.Array of cancel flags of jobs
+        metrics_interval: Seconds between samples of queue depth, None
+            to never sample
+        metrics_file: Path the metrics are exported to by close, see
+            Metrics.export
+        metrics: Metrics of the pool over all jobs, summarized to the
+            log by close
+        throttle: A Throttle shared by all jobs, see MyMaster
+        max_inflight: Max count of items of all jobs submitted but
+            without a result, None for no limit
+
+    """
+    def __init__(self, proc_count=None, thread_count=4, order='alpha', chunksize=None, ack_interval=0.05,
+                 poll_interval=1, shm_threshold=SHM_THRESHOLD, worker_type='thread', scheduler='shared',
+                 preload=(), metrics_interval=1, metrics_file=None, rate_limit=None, rate_burst=None,
+                 key_func=None, key_limit=None, max_inflight=MAX_INFLIGHT):
+        ProcBase.__init__(self, order)
+        self.proc_count = proc_count or multiprocessing.cpu_count()
+        self.thread_count = thread_count
+        self.chunksize = chunksize
+        self.ack_interval = ack_interval
+        self.poll_interval = poll_interval
+        self.worker_type = worker_type
+        self.scheduler = scheduler
+        self.preload = preload
+        self.job_flags = multiprocessing.Array('b', MAX_JOBS, lock=False)
+        self.work_queue = None
+        self.msg_for_proc = None
+        self.worker_pool = []
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._next_job_id = 0
+        self._payloads = PayloadStore(shm_threshold)
+        self._collector = None
+        self.metrics_interval = metrics_interval
+        self.metrics_file = metrics_file
+        self.metrics = None
+        self._completed = 0
+        self._sampling_done = threading.Event()
+        self.throttle = make_throttle(rate_limit, rate_burst, key_func, key_limit, self.proc_count)
+        self._taken = None
+        self._owners = {}
+        self._reaped = set()
+        self.max_inflight = max_inflight
+        self._slots = threading.Semaphore(max_inflight) if max_inflight else None
+
+    def start(self):
+        """Import preloaded modules, then start workers and the collector thread."""
+        for name in self.preload:
+            importlib.import_module(name)
+        resource_tracker.ensure_running()
+        self.work_queue = self.get_scheduler(self.scheduler, self.proc_count)
+        self.msg_for_proc = self.get_msg_for_proc_like_list()
+        self._taken = multiprocessing.SimpleQueue()
+        self.worker_pool = self.start_worker(self.proc_count, self.thread_count, self.work_queue,
+                                             self.msg_for_proc, None, self.ack_interval, self.worker_type,
+                                             self.job_flags, track=self._taken, throttle=self.throttle)
+        self.metrics = Metrics()
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+        if self.metrics_interval:
+            self.start_sampler(self.metrics, self.metrics_interval, self._probe, self._sampling_done)
+        self.set_proc_flag()
+
+    def _consumers(self):
+        return self.proc_count if self.worker_type == 'asyncio' else self.proc_count * self.thread_count
+
+    def _probe(self):
+        with self._lock:
+            inflight = sum(len(job._inflight) for job in self._jobs.values())
+            return self.work_queue.qsize(), inflight, self._completed
+
+    def submit_job(self, func, w_list):
+        """Submit a job to warm workers.
+
+        Args:
+            func: Callable run on each item, it is pickled once and sent
+                with every batch, so it must be a module-level function;
+                if a worker can not load it, like a function defined
+                after start, the items fail with a TaskError
+            w_list: Any iterable of work items, taken a batch for each
+                consumer at a time, the order policy applies within those
+
+        Return:
+            A Job, its count is set when all items are submitted
+
+        """
+        pickled_func = pickle.dumps(func)
+        with self._lock:
+            if self.flag_for_thread.is_set():
+                raise ValueError('submit_job after close')
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            job = Job(self, job_id, func, None)
+            self.job_flags[job_id % MAX_JOBS] = 0
+            self._jobs[job_id] = job
+        chunksize = self._chunksize(len(w_list) if hasattr(w_list, '__len__') else None)
+        items = iter(w_list)
+        submitted = 0
+        while not self.flag_for_abort.is_set():
+            group = list(itertools.islice(items, chunksize * self._consumers()))
+            if not group:
+                break
+            indexed = self.apply_order([((job_id, i), item) for i, item in enumerate(group, submitted)])
+            submitted += len(group)
+            for i in range(0, len(indexed), chunksize):
+                batch = indexed[i:i + chunksize]
+                if self._slots and not self._acquire_many(self._slots, len(batch)):
+                    break
+                with self._lock:
+                    job._inflight.update(batch)
+                self.work_queue.put((pickled_func, [(index, self._payloads.wrap(item)) for index, item in batch]))
+        with self._lock:
+            job.count = submitted
+            finished = job.received == job.count
+            if finished:
+                del self._jobs[job_id]
+        if finished:
+            job._finish()
+        return job
+
+    def _chunksize(self, count):
+        """Count of items in a batch, count is None if the count of items is
+        not known, the batch is then sized by max_inflight."""
+        if count is None:
+            count = self.max_inflight or 0
+        if self.chunksize:
+            chunksize = self.chunksize
+        else:
+            chunksize = max(1, min(MAX_CHUNKSIZE, count // (self.proc_count * self.thread_count * 4)))
+        if self.max_inflight:
+            # Leave a batch for every consumer.
+            chunksize = max(1, min(chunksize, self.max_inflight // self._consumers()))
+        return chunksize
+
+    def map(self, func, w_list):
+        """Run a job and wait for it.
+
+        Return:
+            A list of results in the order of w_list
+
+        """
+        return self.submit_job(func, w_list).results()
+
+    def _deliver(self, index, value):
+        job_id, position = index
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or index not in job._inflight:
+                # Result of an item already failed with its worker.
+                return
+            item = job._inflight.pop(index)
+            job.received += 1
+            self._completed += 1
+            finished = job.received == job.count
+            if finished:
+                del self._jobs[job_id]
+        if self._slots:
+            self._slots.release()
+        self._payloads.release(item)
+        job._results.put((position, value))
+        if finished:
+            job._finish()
+
+    def _reap(self):
+        """Fail items of dead workers and start new workers in their place."""
+        for i, w in enumerate(self.worker_pool):
+            if w.exitcode in (None, 0) or w in self._reaped:
+                continue
+            self._reaped.add(w)
+            if self.throttle is not None:
+                self.throttle.release_worker(i)
+            self._read_taken()
+            lost = [index for index, owner in self._owners.items() if owner == w.worker_id]
+            logger.warning('%s exited with code %s holding %d items', w.worker_id, w.exitcode, len(lost))
+            error = 'worker %s died with exit code %s' % (w.worker_id, w.exitcode)
+            for index in lost:
+                del self._owners[index]
+                with self._lock:
+                    job = self._jobs.get(index[0])
+                    item = job._inflight.get(index) if job else None
+                self._deliver(index, TaskError(item, error))
+            self.worker_pool[i] = self.make_worker(i, self.thread_count, self.work_queue, self.msg_for_proc, None,
+                                                   self.ack_interval, self.worker_type, self.job_flags,
+                                                   track=self._taken, throttle=self.throttle)
+            self.worker_pool[i].start()
+        # Owners of items taken and done before they were read.
+        with self._lock:
+            for index in [index for index in self._owners
+                          if index[0] not in self._jobs or index not in self._jobs[index[0]]._inflight]:
+                del self._owners[index]
+
+    def _collect(self):
+        checked = time.time()
+        while not self.flag_for_abort.is_set():
+            with self._lock:
+                if self.flag_for_thread.is_set() and not self._jobs:
+                    break
+            try:
+                batch = self.msg_for_proc.get(timeout=self.poll_interval)
+            except queue.Empty:
+                batch = None
+            self._read_taken()
+            if isinstance(batch, tuple):
+                self.metrics.add_consumer(batch[1])
+            elif batch:
+                for index, ok, value in batch:
+                    self._owners.pop(index, None)
+                    self._deliver(index, value)
+            if time.time() - checked >= self.poll_interval:
+                checked = time.time()
+                self._reap()
+        self._payloads.clear()
+        self.collect_stats(self.msg_for_proc, self.worker_pool, self.metrics, self._consumers())
+        self._sampling_done.set()
+        self.metrics.finish()
+
+    def close(self):
+        """Wait for submitted jobs, then stop workers, log a summary of
+        metrics and export them to metrics_file."""
+        with self._lock:
+            self.set_thread_flag()
+            self.work_queue.put_sentinel(self._consumers())
+        for w in self.worker_pool:
+            w.join()
+        self._collector.join()
+        logger.info('%s', self.metrics.summary())
+        if self.metrics_file:
+            self.metrics.export(self.metrics_file)
+
+    def terminate(self):
+        """Stop workers at once, jobs not done never finish."""
+        self.set_abort_flag()
+        for w in self.worker_pool:
+            w.join()
+        self._collector.join()
+
+def hybrid_map(func, w_list, proc_count=None, thread_count=4, order='alpha', chunksize=None):
+    """Run func on every item by proc_count processes x thread_count threads.
+
+    Args:
+        func: Callable run on each item
+        w_list: Any iterable of work items
+        proc_count: Count of processes, default one per CPU
+        thread_count: Count of threads in each process
+        order: 'alpha' to run items in order, 'shuffle', or a callable,
+            see ProcBase
+        chunksize: Count of work items sent to a thread at once
+
+    Return:
+        A list of results in the order of w_list, the result of a
+        failed item is a TaskError
+
+    """
+    return MyMaster(w_list, func, proc_count, thread_count, order, chunksize=chunksize).execute()
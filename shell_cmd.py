@@ -2,9 +2,501 @@
 
 import sys
 import os
-import commands
+import re
+import asyncio
+import collections
+import concurrent.futures
+import difflib
+import errno
+import filecmp
+import glob
+import hashlib
+import json
 import logging
+import shlex
 import shutil
+import signal
+import stat
+import struct
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+
+STREAM_LIMIT = 1024 * 1024
+PIPE_GRACE = 0.1
+COPY_BLOCK = 1024 * 1024 * 8
+DELTA_BLOCK = 1024 * 1024
+WALK_WORKERS = 16
+GZIP_BLOCK = 1024 * 1024
+GZIP_LEVEL = 6
+GZIP_SIZE_ID = b'PZ'
+SHELL_CHARS_RE = re.compile(r'[|&;<>()$`\\"\'*?\[\]#~=%{}\n]')
+
+ShellResult = collections.namedtuple('ShellResult', ['cmd', 'returncode', 'output', 'error'])
+BatchResult = collections.namedtuple('BatchResult', ['results', 'failed', 'skipped'])
+SyncResult = collections.namedtuple('SyncResult', ['copied', 'touched', 'deleted', 'unchanged'])
+TreeDiff = collections.namedtuple('TreeDiff', ['only_new', 'only_old', 'changed', 'identical', 'diffs'])
+FILE_TYPES = {stat.S_IFDIR: 'directory', stat.S_IFREG: 'regular file', stat.S_IFLNK: 'symbolic link',
+              stat.S_IFIFO: 'fifo', stat.S_IFSOCK: 'socket', stat.S_IFCHR: 'character special file',
+              stat.S_IFBLK: 'block special file'}
+
+def copy_file_data(src_fd, dst_fd):
+    """Copy all data of a file to another in the kernel if it can.
+
+    os.copy_file_range is tried first, it may share blocks on copy on
+    write file systems, then os.sendfile, then read and write.
+
+    Args:
+        src_fd: File descriptor of source, at offset 0
+        dst_fd: File descriptor of destination, at offset 0
+
+    """
+    for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            if copy is os.sendfile:
+                while os.sendfile(dst_fd, src_fd, None, COPY_BLOCK):
+                    pass
+            else:
+                while copy(src_fd, dst_fd, COPY_BLOCK):
+                    pass
+            return
+        except OSError as e:
+            # Not supported for these files, nothing was copied yet.
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EBADF) \
+                    or os.lseek(dst_fd, 0, os.SEEK_CUR):
+                raise
+    while True:
+        data = os.read(src_fd, COPY_BLOCK)
+        if not data:
+            return
+        os.write(dst_fd, data)
+
+def copy_changed_blocks(src_file, dst_file):
+    """Make dst_file the same as src_file, writing changed blocks only.
+
+    Both are read by DELTA_BLOCK, a block is written only if it differs,
+    then dst_file is cut to the size of src_file. For a big file with a
+    few changes this writes a few blocks instead of the whole file.
+
+    Args:
+        src_file: File object of source opened by 'rb', at offset 0
+        dst_file: File object of destination opened by 'r+b', at offset 0
+
+    Return:
+        Count of bytes written
+
+    """
+    written = 0
+    offset = 0
+    while True:
+        block = src_file.read(DELTA_BLOCK)
+        if not block:
+            break
+        if dst_file.read(len(block)) != block:
+            dst_file.seek(offset)
+            dst_file.write(block)
+            written += len(block)
+        offset += len(block)
+    dst_file.truncate(offset)
+    return written
+
+def files_equal(path1, path2):
+    """Compare data of two files of the same size by DELTA_BLOCK, stop at the first difference."""
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        while True:
+            block = file1.read(DELTA_BLOCK)
+            if block != file2.read(DELTA_BLOCK):
+                return False
+            if not block:
+                return True
+
+def file_digest(path):
+    """Return the sha256 hex digest of the data of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class TreeNode(object):
+    """A dir being walked by TreeWalker, pending counts its children not
+    done yet, and one for the listing of the dir itself."""
+    __slots__ = ('parent', 'path', 'rel', 'pending')
+
+    def __init__(self, parent, path, rel, pending):
+        self.parent = parent
+        self.path = path
+        self.rel = rel
+        self.pending = pending
+
+class TreeWalker(object):
+    """Walk a tree by a pool of threads, for many metadata syscalls at once.
+
+    For each dir, enter is called before anything in it and leave after
+    everything in it is done, so a dir is made before its files are
+    copied and removed after its files are removed. Symlinks are never
+    followed, a symlink to a dir is visited as a file. An exception
+    raised by a callback is kept and the walk goes on, leave is not
+    called for a dir whose listing failed.
+
+    Attributes:
+        workers: Count of threads
+        errors: A list of exceptions raised by callbacks or listing
+
+    """
+    def __init__(self, workers=WALK_WORKERS):
+        self.workers = workers
+        self.errors = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._pool = None
+
+    def walk(self, root, visit, enter=None, leave=None):
+        """Walk a tree.
+
+        Args:
+            root: Path of a dir, or of any file
+            visit: Callable taking (path, rel) of each non-dir, rel is
+                the path relative to root, '' for root itself
+            enter: Callable taking (path, rel) of each dir before its
+                children
+            leave: Callable taking (path, rel) of each dir after its
+                children
+
+        Return:
+            The list of errors
+
+        """
+        self.errors = []
+        self._done.clear()
+        is_dir = os.path.isdir(root) and not os.path.islink(root)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            self._pool = pool
+            pool.submit(self._task, root, '', is_dir, None, visit, enter, leave)
+            self._done.wait()
+        return self.errors
+
+    def _call(self, callback, path, rel):
+        if callback is None:
+            return True
+        try:
+            callback(path, rel)
+            return True
+        except Exception as e:
+            self._error(e)
+            return False
+
+    def _error(self, e):
+        with self._lock:
+            self.errors.append(e)
+
+    def _task(self, path, rel, is_dir, parent, visit, enter, leave):
+        node = parent
+        try:
+            if not is_dir:
+                self._call(visit, path, rel)
+                return
+            if not self._call(enter, path, rel):
+                return
+            # All children are listed before they are counted, so the
+            # count always gets down to zero.
+            with os.scandir(path) as entries:
+                children = [(entry.path, os.path.join(rel, entry.name), entry.is_dir(follow_symlinks=False))
+                            for entry in entries]
+            node = TreeNode(parent, path, rel, len(children) + 1)
+            for child_path, child_rel, child_is_dir in children:
+                self._pool.submit(self._task, child_path, child_rel, child_is_dir, node, visit, enter, leave)
+        except Exception as e:
+            self._error(e)
+        finally:
+            self._finish(node, leave)
+
+    def _finish(self, node, leave):
+        while node is not None:
+            with self._lock:
+                node.pending -= 1
+                if node.pending:
+                    return
+            self._call(leave, node.path, node.rel)
+            node = node.parent
+        self._done.set()
+
+def walk_error(command, e):
+    """Format an error kept by TreeWalker like a message of command."""
+    if isinstance(e, OSError) and e.filename:
+        return '%s: %r: %s' % (command, e.filename, e.strerror)
+    return '%s: %s' % (command, e)
+
+def gzip_member(data, level=GZIP_LEVEL):
+    """Compress data into one whole gzip member.
+
+    The member has an extra subfield GZIP_SIZE_ID holding its own size,
+    as the BGZF format does, so a reader can split members without
+    inflating them. Members concatenated are still one gzip file.
+
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = 20 + len(body) + 8
+    header = struct.pack('<BBBBIBBH2sHI', 0x1f, 0x8b, 8, 4, 0, 0, 255, 8, GZIP_SIZE_ID, 4, size)
+    return header + body + struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+
+def gzip_member_size(extra):
+    """Return the member size in a gzip extra field, or None."""
+    pos = 0
+    while pos + 4 <= len(extra):
+        field_id, field_len = struct.unpack('<2sH', extra[pos:pos + 4])
+        if field_id == GZIP_SIZE_ID and field_len == 4:
+            return struct.unpack('<I', extra[pos + 4:pos + 8])[0]
+        pos += 4 + field_len
+    return None
+
+class GzipBlockWriter(object):
+    """Write gzip to a file object, compressing blocks by a thread pool.
+
+    Like pigz, data is cut into blocks compressed at the same time, zlib
+    releases the GIL while compressing. Each block is a gzip member made
+    by gzip_member, written in order, at most two blocks a worker are
+    held in memory. The file object can be anything with write, like a
+    file or sock.makefile('wb'), it is not closed.
+
+    Attributes:
+        fileobj: File object written to
+        level: Compress level
+        workers: Count of threads
+        block_size: Size of data in a block
+
+    """
+    def __init__(self, fileobj, level=GZIP_LEVEL, workers=None, block_size=GZIP_BLOCK):
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._pending = collections.deque()
+        self._buf = bytearray()
+        self._blocks = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(gzip_member, block, self.level))
+        self._blocks += 1
+        while len(self._pending) > self.workers * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buf += data
+        while len(self._buf) >= self.block_size:
+            self._submit(bytes(self._buf[:self.block_size]))
+            del self._buf[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._buf or not self._blocks:
+                self._submit(bytes(self._buf))
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+            if hasattr(self.fileobj, 'flush'):
+                self.fileobj.flush()
+        finally:
+            self._pool.shutdown(cancel_futures=True)
+
+class GzipBlockReader(object):
+    """Read gzip from a file object, decompressing members by a thread pool.
+
+    Members made by gzip_member are read ahead, at most two a worker,
+    and decompressed at the same time, so the reader, like tarfile
+    writing files, gets data while the next blocks are decompressed.
+    From the first member not having its size, the rest is decompressed
+    in this thread, so any gzip file can be read. The file object is
+    not closed.
+
+    Attributes:
+        fileobj: File object read from
+        workers: Count of threads
+
+    """
+    def __init__(self, fileobj, workers=None):
+        self.fileobj = fileobj
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._chunks = self._decompress()
+        self._buf = b''
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_exact(self, size):
+        data = self.fileobj.read(size)
+        while data and len(data) < size:
+            more = self.fileobj.read(size - len(data))
+            if not more:
+                raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+            data += more
+        return data
+
+    def _decompress(self):
+        pending = collections.deque()
+        while True:
+            head = self._read_exact(12)
+            if not head:
+                break
+            if head[:3] != b'\x1f\x8b\x08':
+                raise OSError('Not a gzipped file (%r)' % head[:2])
+            extra = b''
+            size = None
+            if head[3] & 4:
+                extra = self._read_exact(struct.unpack('<H', head[10:12])[0])
+                size = gzip_member_size(extra)
+            if size is None:
+                while pending:
+                    yield pending.popleft().result()
+                yield from self._inflate(head + extra)
+                return
+            member = head + extra + self._read_exact(size - 12 - len(extra))
+            pending.append(self._pool.submit(zlib.decompress, member, 31))
+            if len(pending) > self.workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _inflate(self, data):
+        inflater = zlib.decompressobj(31)
+        while True:
+            if inflater.eof:
+                data = inflater.unused_data
+                inflater = zlib.decompressobj(31)
+                if not data:
+                    data = self.fileobj.read(GZIP_BLOCK)
+                    if not data:
+                        return
+            elif not data:
+                data = self.fileobj.read(GZIP_BLOCK)
+                if not data:
+                    raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+            yield inflater.decompress(data)
+            data = b''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buf[self._pos:] + b''.join(self._chunks)
+            self._buf, self._pos = b'', 0
+            return data
+        while len(self._buf) - self._pos < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf, self._pos = self._buf[self._pos:] + chunk, 0
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._chunks.close()
+        self._pool.shutdown(cancel_futures=True)
+
+def keep_mode_filter(member, dest_path):
+    """Extraction filter of tarfile keeping modes and owners, like 'tar -x'.
+
+    Unlike the 'tar' filter, setuid, setgid and write bits are kept, so
+    extracted files are as they were packed. Absolute names and names
+    out of dest_path, by '..' or by a symlink extracted before, are
+    refused, so are hard links out of dest_path.
+
+    """
+    if os.path.isabs(member.name):
+        raise tarfile.AbsolutePathError(member)
+    dest = os.path.realpath(dest_path)
+    parent = os.path.realpath(os.path.join(dest, os.path.dirname(member.name)))
+    target = os.path.join(parent, os.path.basename(member.name))
+    if os.path.commonpath([dest, target]) != dest:
+        raise tarfile.OutsideDestinationError(member, target)
+    if member.islnk():
+        linked = os.path.realpath(os.path.join(dest, member.linkname))
+        if os.path.isabs(member.linkname) or os.path.commonpath([dest, linked]) != dest:
+            raise tarfile.LinkOutsideDestinationError(member, linked)
+    return member
+
+def batch_graph(cmds):
+    """Get commands and dependencies of a batch, see BasicCmd.run_batch.
+
+    Args:
+        cmds: A list of commands, or a dict of name to a command or to a
+            tuple of (command, names of commands it runs after)
+
+    Return:
+        A dict of name to (command, list of names it runs after)
+
+    Raises:
+        ValueError: A dependency is unknown or in a cycle
+
+    """
+    if not isinstance(cmds, dict):
+        cmds = dict(enumerate(cmds))
+    graph = {}
+    for name, cmd in cmds.items():
+        if isinstance(cmd, tuple):
+            cmd, after = cmd
+        else:
+            after = ()
+        graph[name] = (cmd, list(after))
+    for name, (cmd, after) in graph.items():
+        for dep in after:
+            if dep not in graph:
+                raise ValueError('%r runs after unknown %r' % (name, dep))
+    # Kahn's algorithm, a cycle leaves names unvisited.
+    waiting = dict((name, len(after)) for name, (cmd, after) in graph.items())
+    ready = [name for name, count in waiting.items() if count == 0]
+    visited = 0
+    while ready:
+        done = ready.pop()
+        visited += 1
+        for name, (cmd, after) in graph.items():
+            if done in after:
+                waiting[name] -= 1
+                if waiting[name] == 0:
+                    ready.append(name)
+    if visited < len(graph):
+        raise ValueError('Cycle in %r' % sorted(name for name, count in waiting.items() if count))
+    return graph
+
+def popen_args(cmd):
+    """Get args of Popen for a command, a shell is started only when the
+    command needs one, for its syntax or a builtin like 'exit'.
+
+    Args:
+        cmd: String of any command, or a list of arguments
+
+    Return:
+        A tuple of (args, shell)
+
+    """
+    if not isinstance(cmd, str):
+        return list(cmd), False
+    if SHELL_CHARS_RE.search(cmd):
+        return cmd, True
+    args = shlex.split(cmd)
+    if not args or shutil.which(args[0]) is None:
+        return cmd, True
+    return args, False
 
 class BasicCmd(object):
     """Basic class of basic commands
@@ -20,15 +512,20 @@ class BasicCmd(object):
         cd: Change work path, like 'cd' command on linux.
         mv: Move files, like 'mv' command on linux.
         cp: Copy files, the same as 'cp -a' command on linux.
+        sync: Copy changed files only, like 'rsync -a --delete' command on linux.
         rmfile: Remove one file, like 'rm -f' command on linux.
         rmdir: Remove one dir, like 'rm -rf' command on linux.
         mkdir: Make dir, like 'mkdir -p' command on linux.
         pathSplit: Split path to four part.
         sh: Run linux command, like 'sh' command on linux.
+        run: Run linux command, streaming its output line by line.
+        run_async: Run linux command in a coroutine, like run.
+        run_batch: Run many linux commands at once, in order of dependencies.
         tarZX: Extract file, like 'tar -zxf' command on linux.
         tarZC: Compress files, like 'tar -zcf' command on linux.
         ln: Create symbol link, like 'ln -s' command on linux.
         diff: Compare files, like 'diff' command on linux.
+        diff_tree: Compare two trees, like 'diff -r' command on linux.
 
     """
     def __init__(self, log_file):
@@ -99,22 +596,275 @@ class BasicCmd(object):
         self.logger.debug('shutil.move(%r, %r)' % (src, dst))
         shutil.move(src, dst)
 
-    def cp(self, src, dst):
+    def _sources(self, src):
+        if not isinstance(src, str):
+            return list(src)
+        if os.path.lexists(src):
+            return [src]
+        sources = []
+        for word in shlex.split(src):
+            sources.extend(sorted(glob.glob(word)) or [word])
+        return sources
+
+    def _copy_stat(self, src, dst, st):
+        if os.geteuid() == 0:
+            os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+        shutil.copystat(src, dst, follow_symlinks=False)
+
+    def _copy_file(self, src, dst, st):
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            copy_file_data(src_file.fileno(), dst_file.fileno())
+        self._copy_stat(src, dst, st)
+
+    def _copy_entry(self, src, dst):
+        """Copy a non-dir like 'cp -a'."""
+        st = os.lstat(src)
+        if os.path.islink(dst) or os.path.lexists(dst) and not os.path.isdir(dst):
+            os.remove(dst)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+            self._copy_stat(src, dst, st)
+        elif stat.S_ISREG(st.st_mode):
+            self._copy_file(src, dst, st)
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+            self._copy_stat(src, dst, st)
+
+    def _copy(self, src, dst, workers):
+        """Copy one path like 'cp -a' by a TreeWalker, return a list of errors.
+
+        Files hard linked together in src are hard linked in dst, the
+        first one copied and the others linked to it.
+
+        """
+        links = {}
+        lock = threading.Lock()
+
+        def enter(path, rel):
+            if not os.path.isdir(os.path.join(dst, rel)):
+                # Writable until leave copies the mode.
+                os.mkdir(os.path.join(dst, rel), 0o700)
+
+        def leave(path, rel):
+            self._copy_stat(path, os.path.join(dst, rel), os.lstat(path))
+
+        def visit(path, rel):
+            each_dst = os.path.join(dst, rel) if rel else dst
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2:
+                self._copy_entry(path, each_dst)
+                return
+            with lock:
+                first = links.get((st.st_dev, st.st_ino))
+                if first is None:
+                    copied = threading.Event()
+                    links[(st.st_dev, st.st_ino)] = (each_dst, copied)
+            if first is None:
+                try:
+                    self._copy_entry(path, each_dst)
+                finally:
+                    copied.set()
+                return
+            first_dst, first_copied = first
+            first_copied.wait()
+            if os.path.lexists(each_dst):
+                os.remove(each_dst)
+            os.link(first_dst, each_dst)
+
+        if not os.path.lexists(src):
+            return ['cp: %r: No such file or directory' % src]
+        errors = TreeWalker(workers).walk(src, visit, enter, leave)
+        return [walk_error('cp', e) for e in errors]
+
+    def cp(self, src, dst, workers=WALK_WORKERS):
         """Copy files, the same as 'cp -a' command on linux.
 
+        Copied in this process, data by copy_file_data, keeping links,
+        modes, owners and times. Trees are walked by workers threads,
+        see TreeWalker.
+
         Args:
             src: path of source
             dst: path of destination
+            workers: Count of threads copying a tree
 
             Because command is 'cp -a', the src can be include
-            several path separated by space
+            several path separated by space, or be a list of paths
 
         """
-        cmd = 'cp -a %s %s' % (src, dst)
-        self.logger.debug(cmd)
-        result = commands.getoutput(cmd)
-        if result:
-            raise Exception(result)
+        sources = self._sources(src)
+        self.logger.debug('cp -a %r %r' % (sources, dst))
+        errors = []
+        if len(sources) > 1 and not os.path.isdir(dst):
+            errors.append('cp: target %r is not a directory' % dst)
+            sources = []
+        for each_src in sources:
+            if os.path.isdir(dst):
+                each_dst = os.path.join(dst, os.path.basename(os.path.normpath(each_src)))
+            else:
+                each_dst = dst
+            errors.extend(self._copy(each_src, each_dst, workers))
+        if errors:
+            raise Exception('\n'.join(errors))
+
+    def _load_manifest(self, manifest):
+        try:
+            with open(manifest) as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _save_manifest(self, manifest, files):
+        tmp_file = '%s.%d.tmp' % (manifest, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': 1, 'files': files}, f)
+        os.replace(tmp_file, manifest)
+
+    def _digest(self, path, st, entry):
+        """Return the digest in a manifest entry if it is of st, or hash the file."""
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and entry[2]:
+            return entry[2]
+        return file_digest(path)
+
+    def _sync_stat(self, src, dst, rel, st, dst_st, result):
+        """Copy the stat of a file whose data is the same."""
+        if (dst_st.st_mode, dst_st.st_uid, dst_st.st_gid) == (st.st_mode, st.st_uid, st.st_gid) \
+                and (dst_st.st_mtime_ns == st.st_mtime_ns or stat.S_ISLNK(st.st_mode)):
+            result.unchanged.append(rel)
+        else:
+            self._copy_stat(src, dst, st)
+            result.touched.append(rel)
+
+    def _sync_file(self, src, dst, rel, old, new, delta, result):
+        """Sync a non-dir, old and new are manifests, None if not used."""
+        st = os.lstat(src)
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if dst_st is not None and stat.S_ISDIR(dst_st.st_mode):
+            self.rmdir(dst)
+            result.deleted.append(rel)
+            dst_st = None
+        same_type = dst_st is not None and stat.S_IFMT(dst_st.st_mode) == stat.S_IFMT(st.st_mode)
+        if not stat.S_ISREG(st.st_mode):
+            if same_type and (os.readlink(src) == os.readlink(dst) if stat.S_ISLNK(st.st_mode)
+                              else dst_st.st_rdev == st.st_rdev):
+                self._sync_stat(src, dst, rel, st, dst_st, result)
+            else:
+                self._copy_entry(src, dst)
+                result.copied.append(rel)
+            return
+        entry = old.get(rel) if old is not None else None
+        digest = None
+        if same_type and dst_st.st_size == st.st_size:
+            if dst_st.st_mtime_ns == st.st_mtime_ns:
+                if new is not None:
+                    new[rel] = entry if entry and entry[:2] == [st.st_size, st.st_mtime_ns] \
+                        else [st.st_size, st.st_mtime_ns, None]
+                self._sync_stat(src, dst, rel, st, dst_st, result)
+                return
+            if new is not None:
+                digest = self._digest(src, st, entry)
+                if digest == self._digest(dst, dst_st, entry):
+                    new[rel] = [st.st_size, st.st_mtime_ns, digest]
+                    self._sync_stat(src, dst, rel, st, dst_st, result)
+                    return
+        if delta and same_type and dst_st.st_nlink == 1 and os.access(dst, os.W_OK):
+            with open(src, 'rb') as src_file, open(dst, 'r+b') as dst_file:
+                copy_changed_blocks(src_file, dst_file)
+            self._copy_stat(src, dst, st)
+        else:
+            self._copy_entry(src, dst)
+        if new is not None:
+            new[rel] = [st.st_size, st.st_mtime_ns, digest]
+        result.copied.append(rel)
+
+    def sync(self, src, dst, delete=True, manifest=None, delta=False, workers=WALK_WORKERS):
+        """Copy changed files only, like 'rsync -a --delete' command on linux.
+
+        Make dst the same as src, like 'rsync -a --delete src/ dst', or
+        as 'cp' when src is not a dir and dst is a dir, sync src into
+        it. A path of one type in dst replaced by another type in src is
+        both deleted and copied. A file whose size and mtime are the same is not copied. If the
+        mtime only differs and manifest is given, data is compared by
+        sha256, the digests are kept in the manifest by size and mtime,
+        so a file not changed since last sync is not hashed again, and
+        a file rebuilt with the same data gets its stat copied only.
+        Trees are walked by workers threads, see TreeWalker.
+
+        Args:
+            src: Path of source dir, or of a file
+            dst: Path of destination
+            delete: Remove files in dst not in src
+            manifest: Path of a JSON file caching digests, better out of
+                dst, or None to compare by size and mtime only
+            delta: Write changed blocks of an existing file only, see
+                copy_changed_blocks, instead of copying the whole file
+            workers: Count of threads
+
+        Return:
+            A SyncResult of relative paths copied, touched (stat copied
+            only), deleted and unchanged
+
+        """
+        self.logger.debug('rsync -a%s %r %r' % (' --delete' if delete else '', src, dst))
+        old = self._load_manifest(manifest) if manifest else None
+        new = {} if manifest else None
+        keep = os.path.abspath(manifest) if manifest else None
+        result = SyncResult([], [], [], [])
+        if os.path.lexists(src) and (os.path.islink(src) or not os.path.isdir(src)) and os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(os.path.normpath(src)))
+
+        def dst_path(rel):
+            return os.path.join(dst, rel) if rel else dst
+
+        def enter(path, rel):
+            each_dst = dst_path(rel)
+            try:
+                dst_st = os.lstat(each_dst)
+            except FileNotFoundError:
+                dst_st = None
+            if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+                os.unlink(each_dst)
+                result.deleted.append(rel)
+                dst_st = None
+            if dst_st is None:
+                # Writable until leave copies the mode.
+                os.mkdir(each_dst, 0o700)
+                return
+            if not os.access(each_dst, os.W_OK | os.X_OK):
+                os.chmod(each_dst, stat.S_IMODE(dst_st.st_mode) | stat.S_IRWXU)
+            if delete:
+                names = set(os.listdir(path))
+                for entry in os.scandir(each_dst):
+                    if entry.name in names or os.path.abspath(entry.path) == keep:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        self.rmdir(entry.path, workers)
+                    else:
+                        os.unlink(entry.path)
+                    result.deleted.append(os.path.join(rel, entry.name))
+
+        def leave(path, rel):
+            self._copy_stat(path, dst_path(rel), os.lstat(path))
+
+        def visit(path, rel):
+            self._sync_file(path, dst_path(rel), rel, old, new, delta, result)
+
+        errors = []
+        if not os.path.lexists(src):
+            errors.append('sync: %r: No such file or directory' % src)
+        else:
+            for e in TreeWalker(workers).walk(src, visit, enter, leave):
+                errors.append(walk_error('sync', e))
+            if manifest:
+                self._save_manifest(manifest, new)
+        self.logger.debug('copied %d, touched %d, deleted %d, unchanged %d'
+                          % tuple(len(each) for each in result))
+        if errors:
+            raise Exception('\n'.join(errors))
+        return result
 
     def rmfile(self, path):
         """Remove one file, like 'rm -f' command on linux.
@@ -127,18 +877,28 @@ class BasicCmd(object):
             self.logger.debug('os.remove(%r)' % path)
             os.remove(path)
 
-    def rmdir(self, path):
+    def rmdir(self, path, workers=WALK_WORKERS):
         """Remove one dir, like 'rm -rf' command on linux.
 
-        Existing path will be deleted only.
+        Existing path will be deleted only. The tree is walked by
+        workers threads, see TreeWalker, files are removed before their
+        dir, and a symlink is removed, not what it points to.
 
         Args:
             path: Any path of dir to be deleted
+            workers: Count of threads removing the tree
+
+        Raises:
+            OSError: Some paths could not be removed, all errors are in
+                the message
 
         """
-        if os.path.exists(path):
-            self.logger.debug('shutil.rmtree(%r)' % path)
-            shutil.rmtree(path)
+        if os.path.lexists(path):
+            self.logger.debug('rm -rf %r' % path)
+            errors = TreeWalker(workers).walk(path, lambda each_path, rel: os.unlink(each_path),
+                                              leave=lambda each_path, rel: os.rmdir(each_path))
+            if errors:
+                raise OSError('\n'.join(walk_error('rm', e) for e in errors))
 
     def mkdir(self, path):
         """Make dir, like 'mkdir -p' command on linux.
@@ -176,60 +936,340 @@ class BasicCmd(object):
         self.logger.debug("Return: %r" % name)
         return name
 
-    def sh(self, cmd, no_output=False):
+    def sh(self, cmd, no_output=False, timeout=None):
         """Run linux command, like 'sh' command on linux.
 
-        Run the command in shell, get the result or not.
+        Run the command by run, get the result or not.
 
         Args:
             cmd: String of any command
-            no_output: Determin whether get the output of the cmd or not
+            no_output: Determin whether get the output of the cmd or not,
+                if not, the output is only logged at info level, stdin
+                is inherited, and it returns when the command exits even
+                if a process it started in background keeps the output
+            timeout: Seconds before the command is killed, None for no limit
 
         Return:
-            If no_output=False, then get the output return from cmd
-            Else, get the status code return from cmd
+            If no_output=False, then get the output return from cmd,
+            stdout and stderr together
+            Else, get the exit code return from cmd
 
         """
-        result = None
         if no_output:
-            self.logger.debug('os.system(%r)' % cmd)
-            result = os.system(cmd)
-        else:
-            self.logger.debug('commands.getoutput(%r)' % cmd)
-            result = commands.getoutput(cmd)
-        return result
+            return self.run(cmd, timeout, on_stdout=self._log_info, on_stderr=self._log_info,
+                            capture=False, stdin=None).returncode
+        output = self.run(cmd, timeout, merge=True).output
+        if output.endswith('\n'):
+            output = output[:-1]
+        return output
+
+    def _log_debug(self, line):
+        self.logger.debug('| %s' % line)
+
+    def _log_info(self, line):
+        self.logger.info(line)
+
+    def _pump(self, stream, callback, sink):
+        for line in stream:
+            callback(line.rstrip('\n'))
+            if sink is not None:
+                sink.append(line)
+        stream.close()
+
+    def _kill(self, proc, cmd, timeout):
+        self.logger.warning('Timeout after %ss, kill: %r' % (timeout, cmd))
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _not_run(self, cmd, e, merge):
+        # Like a shell, which exits with 127 when the command is not found.
+        message = '%s: %s\n' % (cmd, e.strerror)
+        self.logger.warning(message.rstrip())
+        if merge:
+            return ShellResult(cmd, 127, message, '')
+        return ShellResult(cmd, 127, '', message)
+
+    def _join_readers(self, readers, grace):
+        deadline = None if grace is None else time.time() + grace
+        for reader in readers:
+            reader.join(None if deadline is None else max(0, deadline - time.time()))
+
+    def run(self, cmd, timeout=None, on_stdout=None, on_stderr=None, merge=False, capture=True,
+            stdin=subprocess.DEVNULL):
+        """Run linux command, streaming its output line by line.
+
+        The command is run without a shell unless it needs one, in its
+        own process group, so a timeout kills its children too. Lines of
+        stdout and stderr are given to the callbacks as they come, by
+        default they are logged at debug level. Without capture, it
+        waits PIPE_GRACE seconds only for the output after the command
+        exits, so a daemon started by it, keeping the pipes open, does
+        not block; its output is still streamed to the callbacks.
+
+        Args:
+            cmd: String of any command, or a list of arguments
+            timeout: Seconds before the command is killed, None for no limit
+            on_stdout: Callable taking each line of stdout
+            on_stderr: Callable taking each line of stderr
+            merge: Whether to send stderr to stdout, as a shell '2>&1'
+            capture: Whether to keep the output, False to only stream it
+            stdin: stdin of the command, None to inherit it
+
+        Return:
+            A ShellResult of (cmd, returncode, output, error)
 
-    def tarZX(self, file_name, dst_path='.'):
+        Raises:
+            subprocess.TimeoutExpired: The command ran over timeout and
+                was killed, the output so far is kept in it
+
+        """
+        args, shell = popen_args(cmd)
+        self.logger.debug('subprocess.Popen(%r, shell=%r)' % (args, shell))
+        grace = None if capture else PIPE_GRACE
+        try:
+            proc = subprocess.Popen(args, shell=shell, stdin=stdin, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT if merge else subprocess.PIPE,
+                                    universal_newlines=True, errors='replace', start_new_session=True)
+        except OSError as e:
+            return self._not_run(cmd, e, merge)
+        output = [] if capture else None
+        error = [] if capture else None
+        streams = [(proc.stdout, on_stdout, output)]
+        if not merge:
+            streams.append((proc.stderr, on_stderr, error))
+        readers = []
+        for stream, callback, sink in streams:
+            reader = threading.Thread(target=self._pump, args=(stream, callback or self._log_debug, sink))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+        try:
+            returncode = proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(proc, cmd, timeout)
+            proc.wait()
+            self._join_readers(readers, grace)
+            raise subprocess.TimeoutExpired(cmd, timeout, ''.join(output or ''), ''.join(error or ''))
+        self._join_readers(readers, grace)
+        self.logger.debug('Return: %r' % returncode)
+        return ShellResult(cmd, returncode, ''.join(output or ''), ''.join(error or ''))
+
+    async def _pump_async(self, stream, callback, sink):
+        # Lines are split here, as stream.readline fails on a line over
+        # the limit of the stream.
+        pending = bytearray()
+        while True:
+            chunk = await stream.read(STREAM_LIMIT)
+            if chunk:
+                pending += chunk
+                end = pending.rfind(b'\n') + 1
+                if not end:
+                    continue
+                lines = [line + '\n' for line in pending[:end - 1].decode('utf-8', 'replace').split('\n')]
+                del pending[:end]
+            elif pending:
+                lines = [pending.decode('utf-8', 'replace')]
+            else:
+                return
+            for line in lines:
+                callback(line.rstrip('\n'))
+                if sink is not None:
+                    sink.append(line)
+            if not chunk:
+                return
+
+    async def _join_pumps(self, pumps, grace):
+        done, pending = await asyncio.wait(pumps, timeout=grace)
+        for pump in pending:
+            pump.cancel()
+        for pump in done:
+            pump.result()
+
+    async def run_async(self, cmd, timeout=None, on_stdout=None, on_stderr=None, merge=False, capture=True):
+        """Run linux command in a coroutine, like run.
+
+        Many commands may so run at once from one thread, by
+        asyncio.gather of run_async calls. Whether the output is captured
+        or not, it waits PIPE_GRACE seconds only for the output after the
+        command exits, so a daemon started by it does not block.
+
+        Args:
+            cmd: String of any command, or a list of arguments
+            timeout: Seconds before the command is killed, None for no limit
+            on_stdout: Callable taking each line of stdout
+            on_stderr: Callable taking each line of stderr
+            merge: Whether to send stderr to stdout, as a shell '2>&1'
+            capture: Whether to keep the output, False to only stream it
+
+        Return:
+            A ShellResult of (cmd, returncode, output, error)
+
+        Raises:
+            subprocess.TimeoutExpired: The command ran over timeout and
+                was killed, the output so far is kept in it
+
+        """
+        args, shell = popen_args(cmd)
+        self.logger.debug('asyncio subprocess(%r, shell=%r)' % (args, shell))
+        kwargs = dict(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                      stderr=subprocess.STDOUT if merge else subprocess.PIPE,
+                      start_new_session=True, limit=STREAM_LIMIT)
+        try:
+            if shell:
+                proc = await asyncio.create_subprocess_shell(args, **kwargs)
+            else:
+                proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+        except OSError as e:
+            return self._not_run(cmd, e, merge)
+        output = [] if capture else None
+        error = [] if capture else None
+        pumps = [asyncio.ensure_future(self._pump_async(proc.stdout, on_stdout or self._log_debug, output))]
+        if not merge:
+            pumps.append(asyncio.ensure_future(self._pump_async(proc.stderr, on_stderr or self._log_debug, error)))
+        try:
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._kill(proc, cmd, timeout)
+                await self._join_pumps(pumps, PIPE_GRACE)
+                raise subprocess.TimeoutExpired(cmd, timeout, ''.join(output or ''), ''.join(error or ''))
+            await self._join_pumps(pumps, PIPE_GRACE)
+        finally:
+            if proc.returncode is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            for pump in pumps:
+                pump.cancel()
+            await proc.wait()
+            # Pipes still held by a daemon are closed with the transport,
+            # asyncio.subprocess.Process has no public way to do it.
+            proc._transport.close()
+        self.logger.debug('Return: %r' % proc.returncode)
+        return ShellResult(cmd, proc.returncode, ''.join(output or ''), ''.join(error or ''))
+
+    def _log_named(self, name):
+        return lambda line: self.logger.debug('[%s] %s' % (name, line))
+
+    async def run_batch_async(self, cmds, limit=8, timeout=None, keep_going=True):
+        """Run many linux commands at once in a coroutine, see run_batch."""
+        graph = batch_graph(cmds)
+        semaphore = asyncio.Semaphore(limit)
+        tasks = {}
+        results = {}
+        failed = []
+        skipped = []
+
+        async def run_one(name):
+            cmd, after = graph[name]
+            for dep in after:
+                await tasks[dep]
+            if any(dep in failed or dep in skipped for dep in after) or (failed and not keep_going):
+                skipped.append(name)
+                return
+            async with semaphore:
+                if failed and not keep_going:
+                    skipped.append(name)
+                    return
+                log = self._log_named(name)
+                try:
+                    result = await self.run_async(cmd, timeout, on_stdout=log, on_stderr=log)
+                except subprocess.TimeoutExpired as e:
+                    result = ShellResult(cmd, None, e.output, e.stderr)
+            results[name] = result
+            if result.returncode != 0:
+                self.logger.warning('[%s] %r failed, returncode %r' % (name, cmd, result.returncode))
+                failed.append(name)
+
+        for name in graph:
+            tasks[name] = asyncio.ensure_future(run_one(name))
+        await asyncio.gather(*tasks.values())
+        self.logger.debug('Return: %d done, %d failed, %d skipped' % (len(results), len(failed), len(skipped)))
+        return BatchResult(results, failed, skipped)
+
+    def run_batch(self, cmds, limit=8, timeout=None, keep_going=True):
+        """Run many linux commands at once, in order of dependencies.
+
+        Commands are run by run_async, at most limit at a time, each as
+        soon as the commands it runs after succeeded. A command after a
+        failed or skipped one is skipped. Output lines are logged at
+        debug level with the name of the command.
+
+        Args:
+            cmds: A list of commands, or a dict of name to a command or
+                to a tuple of (command, names of commands it runs after)
+            limit: Max count of commands running at once
+            timeout: Seconds before each command is killed, None for no limit
+            keep_going: Whether to start more commands after one failed
+
+        Return:
+            A BatchResult of (results, failed, skipped), results is a dict
+            of name, the index for a list, to ShellResult, the returncode
+            is None if the command timed out, failed and skipped are lists
+            of names
+
+        Raises:
+            ValueError: A dependency is unknown or in a cycle
+
+        """
+        return asyncio.run(self.run_batch_async(cmds, limit, timeout, keep_going))
+
+    def tarZX(self, file_name, dst_path='.', workers=None):
         """Extract file, like 'tar -zxf' command on linux.
 
-        Run 'tar' command in subshell, extract the tar.gz file.
+        Extract the tar.gz file by tarfile, reading it as a stream from
+        a GzipBlockReader, so files are written while next blocks are
+        decompressed by workers threads. Modes are kept, paths out of
+        dst_path are refused, see keep_mode_filter.
 
         Args:
-            file_name: The name of tar file
+            file_name: The name of tar file, or a file object to read
             dst_path: Destinate path extracted to
+            workers: Count of threads decompressing
 
         Result:
-            Any messages while running the command
+            Any messages while extracting
 
         """
-        cmd = 'tar -zxf %s -C %s > /dev/null' % (file_name, dst_path)
-        self.logger.debug(cmd)
-        result = commands.getoutput(cmd)
+        self.logger.debug('tarfile.open(%r, %r).extractall(%r)' % (file_name, 'r|gz', dst_path))
+        result = ''
+        try:
+            own_file = not hasattr(file_name, 'read')
+            fileobj = open(file_name, 'rb') if own_file else file_name
+            try:
+                with GzipBlockReader(fileobj, workers) as gz, tarfile.open(fileobj=gz, mode='r|') as tar:
+                    if hasattr(tarfile, 'tar_filter'):
+                        tar.extractall(dst_path, filter=keep_mode_filter)
+                    else:
+                        tar.extractall(dst_path)
+            finally:
+                if own_file:
+                    fileobj.close()
+        except (tarfile.TarError, OSError, EOFError, zlib.error) as e:
+            result = 'tar: %s' % e
         if result:
             self.logger.warning('Return:\n%s' % result)
         return result
         
-    def tarZC(self, file_name, src_path):
+    def tarZC(self, file_name, src_path, workers=None, level=GZIP_LEVEL):
         """Compress files, like 'tar -zcf' command on linux.
 
-        Run 'tar' command in subshell, make the tar.gz file.
+        Make the tar.gz file by tarfile, writing it as a stream to a
+        GzipBlockWriter, which compresses blocks by workers threads like
+        pigz. Any gzip tool can read the file.
 
         Args:
-            file_name: The tar.gz file name to be made
+            file_name: The tar.gz file name to be made, or a file object
+                to write, like sock.makefile('wb')
             src_path: A path list to be Compress
+            workers: Count of threads compressing
+            level: Compress level
 
         Return:
-            Any messages while running the command
+            Any messages while compressing
 
         """
         src_path_list = []
@@ -238,9 +1278,20 @@ class BasicCmd(object):
                 src_path_list.append(each_path)
             else:
                 self.logger.warning('<font color=orange><b>tar: %r: Cannot stat: No such file or directory. Skip it.</b></font>' % each_path)
-        cmd = 'tar -zcf %s %s > /dev/null' % (file_name, ' '.join(src_path_list))
-        self.logger.debug(cmd)
-        result = commands.getoutput(cmd)
+        self.logger.debug('tarfile.open(%r, %r).add(%r)' % (file_name, 'w|gz', src_path_list))
+        result = ''
+        try:
+            own_file = not hasattr(file_name, 'write')
+            fileobj = open(file_name, 'wb') if own_file else file_name
+            try:
+                with GzipBlockWriter(fileobj, level, workers) as gz, tarfile.open(fileobj=gz, mode='w|') as tar:
+                    for each_path in src_path_list:
+                        tar.add(each_path)
+            finally:
+                if own_file:
+                    fileobj.close()
+        except (tarfile.TarError, OSError) as e:
+            result = 'tar: %s' % e
         if result:
             self.logger.warning('Return:\n%s' % result)
         return result
@@ -262,11 +1313,137 @@ class BasicCmd(object):
         self.logger.debug('os.symlink(%r, %r)' % (src_path, dst_path))
         os.symlink(src_path, dst_path)
 
+    def _read_lines(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if b'\0' in data:
+            return None
+        return data.decode('utf-8', 'surrogateescape').splitlines(True)
+
+    def _diff_files(self, new, old):
+        if filecmp.cmp(new, old, shallow=False):
+            return 'Files %s and %s are identical' % (new, old)
+        return self._diff_text(new, old)
+
+    def _diff_text(self, new, old):
+        new_lines = self._read_lines(new)
+        old_lines = self._read_lines(old)
+        if new_lines is None or old_lines is None:
+            return 'Binary files %s and %s differ' % (new, old)
+        return ''.join(difflib.unified_diff(new_lines, old_lines, new, old)).rstrip('\n')
+
+    def _scan(self, root, workers):
+        """Return lstat of all paths in a tree by relative path."""
+        found = {}
+
+        def visit(path, rel):
+            found[rel] = os.lstat(path)
+
+        errors = TreeWalker(workers).walk(root, visit, visit)
+        return found, errors
+
+    def _diff_pair(self, new, old, new_st, old_st, shallow, lines):
+        """Compare two paths of a tree, return None if the same, or a message."""
+        new_type, old_type = stat.S_IFMT(new_st.st_mode), stat.S_IFMT(old_st.st_mode)
+        if new_type != old_type:
+            return 'File %s is a %s while file %s is a %s' % (new, FILE_TYPES.get(new_type, 'file'),
+                                                           old, FILE_TYPES.get(old_type, 'file'))
+        if new_type == stat.S_IFDIR:
+            return None
+        if new_type == stat.S_IFLNK:
+            new_link, old_link = os.readlink(new), os.readlink(old)
+            if new_link == old_link:
+                return None
+            return 'Symbolic links %s -> %s and %s -> %s differ' % (new, new_link, old, old_link)
+        if new_type != stat.S_IFREG:
+            return None if new_st.st_rdev == old_st.st_rdev else 'Files %s and %s differ' % (new, old)
+        if new_st.st_size == old_st.st_size:
+            if shallow and new_st.st_mtime_ns == old_st.st_mtime_ns:
+                return None
+            if files_equal(new, old):
+                return None
+        if not lines:
+            return 'Files %s and %s differ' % (new, old)
+        return self._diff_text(new, old)
+
+    def diff_tree(self, new, old, shallow=True, lines=True, workers=WALK_WORKERS):
+        """Compare two trees, like 'diff -r' command on linux.
+
+        Both trees are walked at the same time by TreeWalker. Files of
+        different sizes differ without reading them, files of the same
+        size and mtime are the same if shallow, others are compared
+        block by block by workers threads, and line diffs are made for
+        files which differ only.
+
+        Args:
+            new: A path of new dir
+            old: A path of old dir
+            shallow: Take files of the same size and mtime as the same
+            lines: Make unified diffs of text files which differ
+            workers: Count of threads
+
+        Return:
+            A TreeDiff of sorted relative paths only in new, only in old
+            (a dir only, not paths in it), changed and identical, and
+            diffs, a dict of the diff message of each changed path
+
+        """
+        self.logger.debug('diff -r %r %r' % (new, old))
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            new_scan = pool.submit(self._scan, new, workers)
+            old_scan = pool.submit(self._scan, old, workers)
+            (new_found, new_errors), (old_found, old_errors) = new_scan.result(), old_scan.result()
+        for e in new_errors + old_errors:
+            self.logger.warning(walk_error('diff', e))
+        only_new = sorted(rel for rel in new_found if rel not in old_found and os.path.dirname(rel) in old_found)
+        only_old = sorted(rel for rel in old_found if rel not in new_found and os.path.dirname(rel) in new_found)
+        common = sorted(rel for rel in new_found if rel in old_found)
+
+        def compare(rel):
+            try:
+                return self._diff_pair(os.path.join(new, rel) if rel else new, os.path.join(old, rel) if rel else old,
+                                       new_found[rel], old_found[rel], shallow, lines)
+            except OSError as e:
+                return 'diff: %s: %s' % (e.filename, e.strerror)
+
+        changed, identical, diffs = [], [], {}
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            for rel, message in zip(common, pool.map(compare, common)):
+                if message is None:
+                    identical.append(rel)
+                else:
+                    changed.append(rel)
+                    diffs[rel] = message
+        return TreeDiff(only_new, only_old, changed, identical, diffs)
+
+    def _diff(self, new, old):
+        """Compare two paths like 'diff -r', return the report."""
+        try:
+            if os.path.isdir(new) and os.path.isdir(old):
+                tree = self.diff_tree(new, old)
+                lines = []
+                for root, only in ((new, tree.only_new), (old, tree.only_old)):
+                    for rel in only:
+                        lines.append('Only in %s: %s' % (os.path.join(root, os.path.dirname(rel)).rstrip(os.sep) or root,
+                                                         os.path.basename(rel)))
+                lines += [tree.diffs[rel] for rel in tree.changed]
+                lines.append('%d paths are identical' % len(tree.identical))
+                return '\n'.join(lines)
+            if os.path.isdir(new):
+                new = os.path.join(new, os.path.basename(old))
+            elif os.path.isdir(old):
+                old = os.path.join(old, os.path.basename(new))
+            return self._diff_files(new, old)
+        except OSError as e:
+            return 'diff: %s: %s' % (e.filename, e.strerror)
+
     def diff(self, new, old):
         """Compare files, like 'diff' command on linux.
 
         Compare files, it will print some messages if the file name not exists
         in the 'new' argument or in the 'old' argument or both.
+        Compared in this process, a unified diff of text files, two dirs
+        are compared as whole trees by diff_tree.
 
         Args:
             new: A path of new file
@@ -280,7 +1457,6 @@ class BasicCmd(object):
         elif not os.path.exists(new) and not os.path.exists(old):
             self.logger.warning('<font color=orange><b>Both not exists %r %r</b></font>' % (new, old))
         else:
-            cmd = 'diff --report-identical-files %s %s' % (new, old)
-            self.logger.debug(cmd)
-            self.logger.info('%s BEGIN %s\n<font color=green><< New: %r\n>> Old: %r</font>\n<b>%s</b>' % ('='*10, '='*10, new, old, commands.getoutput(cmd)))
+            self.logger.debug('diff -r %r %r' % (new, old))
+            self.logger.info('%s BEGIN %s\n<font color=green><< New: %r\n>> Old: %r</font>\n<b>%s</b>' % ('='*10, '='*10, new, old, self._diff(new, old)))
             self.logger.info('%s END %s' % ('='*10, '='*10))